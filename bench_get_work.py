@@ -0,0 +1,64 @@
+"""Controller work allocation throughput against required volume
+
+    python bench_get_work.py [SECONDS_PER_CASE]
+
+Each case splits the volume over 10 scenarios. The spawn rate keeps every request's limit small while
+the deficit stays the size of the whole volume, the worst case for allocation, as in a ramp up.
+"""
+import sys
+import time
+
+from mite.scenario import ScenarioManager
+from mite.controller import Controller
+from mite.config import ConfigManager
+
+VOLUMES = [1000, 10000, 100000, 500000]
+NUM_SCENARIOS = 10
+NUM_RUNNERS = 50
+
+
+def _scenario_manager(volume):
+    scenario_manager = ScenarioManager(spawn_rate=1000)
+    for i in range(NUM_SCENARIOS):
+        scenario_manager.add_scenario('mite.example:journey', None, lambda start, end: volume // NUM_SCENARIOS)
+    return scenario_manager
+
+
+def bench_get_work(volume, seconds):
+    scenario_manager = _scenario_manager(volume)
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        scenario_manager.get_work({}, 0, NUM_RUNNERS, None, 100)
+        n += 1
+    return n / (time.perf_counter() - start)
+
+
+def bench_request_work(volume, seconds):
+    # Runners only ever finish a tenth of their work between requests, so there's always a deficit
+    controller = Controller('bench', _scenario_manager(volume), ConfigManager())
+    runner_ids = [controller.hello()[0] for _ in range(NUM_RUNNERS)]
+    current = {runner_id: {} for runner_id in runner_ids}
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        runner_id = runner_ids[n % NUM_RUNNERS]
+        work, config_list, stop = controller.request_work(runner_id, current[runner_id], [])
+        runner_work = current[runner_id]
+        for scenario_id in runner_work:
+            runner_work[scenario_id] -= runner_work[scenario_id] // 10
+        for scenario_id, scenario_data_id, journey_spec, args, start_delay in work:
+            runner_work[scenario_id] = runner_work.get(scenario_id, 0) + 1
+        n += 1
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    print('%10s %18s %22s' % ('volume', 'get_work calls/s', 'request_work calls/s'))
+    for volume in VOLUMES:
+        print('%10d %18.0f %22.0f' % (volume, bench_get_work(volume, seconds), bench_request_work(volume, seconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
-import msgpack
 import sys
 
-unpacker = msgpack.Unpacker(open(sys.argv[1], 'rb'), encoding='utf-8', use_list=False)
-for row in unpacker:
-    print(row)
+from mite.utils import StreamDecoder
 
+# Share one decoder so compact header definitions carry over from one rolled collector file to the next
+decoder = StreamDecoder()
+for fn in sys.argv[1:]:
+    for row in decoder.decode_file(fn):
+        print(row)
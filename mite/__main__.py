@@ -31,8 +31,16 @@ Options:
     --spawn-rate=NUM_PER_SECOND     Maximum spawn rate [default: 1000]
     --max-loop-delay=SECONDS        Runner internal loop delay maximum [default: 1]
     --min-loop-delay=SECONDS        Runner internal loop delay minimum [default: 0]
-    --runner-max-journeys=NUMBER    Max number of concurrent journeys a runner can run
+    --runner-max-journeys=NUMBER    Max number of concurrent journeys a runner can run, auto to work it out from the runner's loop lag and CPU
+    --health-period=SECONDS         How often a runner sends a runner_health message [default: 5]
+    --runner-max-lag=SECONDS        Controller stops giving work to runners whose event loop lags more than this
+    --runner-weight=WEIGHT          Runner's share of the volume relative to other runners, e.g. its core count, by default its max journeys
+    --subscribe                     Runner has work pushed by the controller as soon as it's needed instead of polling for it
+    --virtual-users                 Runner keeps one long lived worker per concurrent journey rather than a task per journey run
+    --processes=NUM                 Runner worker processes, 0 for one per core [default: 1]
     --controller-socket=SOCKET      Controller socket [default: tcp://127.0.0.1:14301]
+    --controller-timeout=SECONDS    How long a runner waits for the controller to reply before retrying [default: 5]
+    --controller-retries=NUM        How many times a runner retries a request to the controller [default: 3]
     --message-socket=SOCKET         Message socket [default: tcp://127.0.0.1:14302]
     --collector-socket=SOCKET       Socket [default: tcp://127.0.0.1:14303]
     --stats-in-socket=SOCKET        Socket [default: tcp://127.0.0.1:14304]
@@ -40,16 +48,28 @@ Options:
     --delay-start-seconds=DELAY     Delay start allowing others to connect [default: 0]
     --volume=VOLUME                 Volume to run journey at [default: 1]
     --web-address=HOST_PORT         Web bind address [default: 127.0.0.1:9301]
-    --message-backend=BACKEND       Backend to transport messages over [default: ZMQ]
+    --message-backend=BACKEND       Backend to transport messages over, ZMQ, nanomsg or shm (shared memory rings, message sockets are then directories) [default: ZMQ]
+    --message-batch-size=NUM        Max number of messages sent together in one batch [default: 100]
+    --message-batch-delay=SECONDS   Max time a message waits for its batch to fill before being sent [default: 0.01]
+    --compact-messages              Send context headers once per context/transaction and messages as positional arrays
+    --message-compression=CODEC     Compress message batches with zlib or lz4, both using a preset dictionary
+    --message-hwm=NUM               High water mark for frames queued on a message sender [default: 1000]
+    --message-overflow=POLICY       What a message sender does at the high water mark: block, drop-oldest or drop-newest [default: block]
     --exclude-working-directory     By default mite puts the current directory on the python path
+    --duplicator-queue-size=NUM     Max messages queued per duplicator output before they are dropped [default: 10000]
     --collector-dir=DIRECTORY       Set the collectors output directory [default: collector_data]
     --collector-role=NUM_LINES      How many lines per collector output file [default: 100000]
 """
 import sys
 import os
+import tempfile
+import time
+import socket
 import asyncio
 import docopt
 import threading
+from collections import defaultdict
+from types import MappingProxyType
 import logging
 import uvloop
 
@@ -62,6 +82,8 @@ from .utils import spec_import, pack_msg
 from .web import app, prometheus_metrics
 from .logoutput import MsgOutput, HttpStatsOutput
 from .stats import Stats
+from .supervisor import RunnerSupervisor, WorkerProcesses
+from .health import HealthSampler, CapacityController
 
 
 def _msg_backend_module(opts):
@@ -72,6 +94,9 @@ def _msg_backend_module(opts):
     elif msg_backend == 'ZMQ':
         from . import zmq
         return zmq
+    elif msg_backend == 'shm':
+        from . import shm
+        return shm
     else:
         raise ValueError('Unsupported backend %r' % (msg_backend,))
 
@@ -91,7 +116,14 @@ def _collector_receiver(opts):
 
 def _create_sender(opts):
     socket = opts['--message-socket']
-    sender = _msg_backend_module(opts).Sender()
+    sender = _msg_backend_module(opts).Sender(
+        batch_size=int(opts['--message-batch-size']),
+        batch_delay=float(opts['--message-batch-delay']),
+        compact=opts['--compact-messages'],
+        compression=opts['--message-compression'],
+        hwm=int(opts['--message-hwm']),
+        overflow=opts['--message-overflow']
+    )
     sender.connect(socket)
     return sender
 
@@ -119,7 +151,11 @@ def _create_prometheus_exporter_receiver(opts):
 
 def _create_runner_transport(opts):
     socket = opts['--controller-socket']
-    return _msg_backend_module(opts).RunnerTransport(socket)
+    return _msg_backend_module(opts).RunnerTransport(
+        socket,
+        timeout=float(opts['--controller-timeout']),
+        retries=int(opts['--controller-retries'])
+    )
 
 
 def _create_controller_server(opts):
@@ -128,51 +164,102 @@ def _create_controller_server(opts):
 
 
 def _create_duplicator(opts):
-    return _msg_backend_module(opts).Duplicator(opts['--message-socket'], opts['OUT_SOCKET'])
+    return _msg_backend_module(opts).Duplicator(
+        opts['--message-socket'],
+        opts['OUT_SOCKET'],
+        max_queue=int(opts['--duplicator-queue-size'])
+    )
 
 
 logger = logging.getLogger(__name__)
 
 
+def _schedule_sender_report(sender, loop, period=1):
+    sender_name = '%s:%d' % (socket.gethostname(), os.getpid())
+    reported = {}
+    def sender_report():
+        dropped = {}
+        for msg_type, total in sender.dropped.items():
+            if total > reported.get(msg_type, 0):
+                dropped[msg_type] = total - reported.get(msg_type, 0)
+                reported[msg_type] = total
+        if dropped:
+            logger.warning('message sender dropped %r since last report', dropped)
+            sender.send({'type': 'sender_report', 'time': time.time(), 'sender': sender_name, 'dropped': dropped})
+        loop.call_later(period, sender_report)
+    loop.call_later(period, sender_report)
+
+
 class DirectRunnerTransport:
-    def __init__(self, controller):
+    def __init__(self, controller, push_interval=0.01):
         self._controller = controller
+        self._push_interval = push_interval
 
-    async def hello(self):
-        return self._controller.hello()
+    async def hello(self, weight=None):
+        return self._controller.hello(weight)
 
-    async def request_work(self, runner_id, current_work, completed_data_ids, max_work):
-        return self._controller.request_work(runner_id, current_work, completed_data_ids, max_work)
+    async def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        return self._controller.request_work(runner_id, current_work, completed_data_ids, max_work, runner_stats)
 
     async def bye(self, runner_id):
         return self._controller.bye(runner_id)
 
+    async def subscribe(self, runner_id, max_work):
+        return self._controller.subscribe(runner_id, max_work)
+
+    async def report_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        return self._controller.report_work(runner_id, current_work, completed_data_ids, max_work, runner_stats)
+
+    async def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        return self._controller.lease_data(runner_id, scenario_id, returned, lease)
+
+    async def next_push(self):
+        # There's only the one runner in process
+        while True:
+            pushes = self._controller.get_pushes()
+            if pushes:
+                return pushes[0][1]
+            await asyncio.sleep(self._push_interval)
+
 
 class DirectReciever:
+    """In process message bus for single process test modes
+
+    Listeners get a read only view of each message, optionally only for the message types they
+    subscribe to. Messages are only packed when there is a raw listener to hand them to.
+    """
     def __init__(self):
         self._listeners = []
+        self._typed_listeners = defaultdict(list)
         self._raw_listeners = []
 
-    def add_listener(self, listener):
-        self._listeners.append(listener)
+    def add_listener(self, listener, types=None):
+        if types is None:
+            self._listeners.append(listener)
+        else:
+            for msg_type in types:
+                self._typed_listeners[msg_type].append(listener)
 
     def add_raw_listener(self, raw_listener):
         self._raw_listeners.append(raw_listener)
 
     def recieve(self, msg):
+        if self._raw_listeners:
+            packed_msg = pack_msg(msg)
+            for raw_listener in self._raw_listeners:
+                raw_listener(packed_msg)
+        view = MappingProxyType(msg)
         for listener in self._listeners:
-            listener(msg)
-        packed_msg = pack_msg(msg)
-        for raw_listener in self._raw_listeners:
-            raw_listener(packed_msg)
+            listener(view)
+        for listener in self._typed_listeners.get(msg.get('type'), ()):
+            listener(view)
 
 
 def _setup_msg_processors(receiver, opts):
     collector = Collector(opts['--collector-dir'], int(opts['--collector-role']))
     msg_output = MsgOutput()
     http_stats_output = HttpStatsOutput()
-    receiver.add_listener(collector.process_message)
-    receiver.add_listener(http_stats_output.process_message)
+    receiver.add_listener(http_stats_output.process_message, types=('http_curl_metrics', 'error', 'exception'))
     receiver.add_listener(msg_output.process_message)
     receiver.add_raw_listener(collector.process_raw_message)
 
@@ -207,25 +294,44 @@ def _create_config_manager(opts):
     return config_manager
 
 
+def _runner_weight(opts):
+    if opts['--runner-weight']:
+        return float(opts['--runner-weight'])
+    return None
+
+
 def _create_runner(opts, transport, msg_senders):
     loop_wait_max = float(opts['--max-loop-delay'])
     loop_wait_min = float(opts['--min-loop-delay'])
     max_work = None
-    if opts['--runner-max-journeys']:
+    health_sampler = HealthSampler()
+    capacity_controller = None
+    if opts['--runner-max-journeys'] == 'auto':
+        capacity_controller = CapacityController(health_sampler)
+    elif opts['--runner-max-journeys']:
         max_work = int(opts['--runner-max-journeys'])
-    return Runner(transport, msg_senders, loop_wait_min=loop_wait_min, loop_wait_max=loop_wait_max, max_work=max_work, debug=opts['--debugging'])
+    return Runner(transport, msg_senders, loop_wait_min=loop_wait_min, loop_wait_max=loop_wait_max, max_work=max_work, debug=opts['--debugging'],
+                  subscribe=opts['--subscribe'], virtual_users=opts['--virtual-users'], health_sampler=health_sampler,
+                  health_period=float(opts['--health-period']), capacity_controller=capacity_controller,
+                  weight=_runner_weight(opts))
 
 
 def _create_scenario_manager(opts):
     return ScenarioManager(start_delay=float(opts['--delay-start-seconds']), period=float(opts['--max-loop-delay']), spawn_rate=int(opts['--spawn-rate']))
 
 
+def _runner_max_lag(opts):
+    if opts['--runner-max-lag']:
+        return float(opts['--runner-max-lag'])
+    return None
+
+
 def test_scenarios(test_name, opts, scenarios):
     scenario_manager = _create_scenario_manager(opts)
     for journey_spec, datapool, volumemodel in scenarios:
         scenario_manager.add_scenario(journey_spec, datapool, volumemodel)
     config_manager = _create_config_manager(opts)
-    controller = Controller(test_name, scenario_manager, config_manager)
+    controller = Controller(test_name, scenario_manager, config_manager, runner_max_lag=_runner_max_lag(opts))
     transport = DirectRunnerTransport(controller)
     receiver = DirectReciever()
     _setup_msg_processors(receiver, opts)
@@ -271,7 +377,7 @@ def controller(opts):
     for journey_spec, datapool, volumemodel in scenarios:
         scenario_manager.add_scenario(journey_spec, datapool, volumemodel)
     config_manager = _create_config_manager(opts)
-    controller = Controller(scenario_spec, scenario_manager, config_manager)
+    controller = Controller(scenario_spec, scenario_manager, config_manager, runner_max_lag=_runner_max_lag(opts))
     server = _create_controller_server(opts)
     sender = _create_sender(opts)
     loop = asyncio.get_event_loop()
@@ -279,26 +385,79 @@ def controller(opts):
         controller.report(sender.send)
         loop.call_later(1, controller_report)
     loop.call_later(1, controller_report)
+    _schedule_sender_report(sender, loop)
     loop.run_until_complete(server.run(controller, controller.should_stop))
+    sender.flush()
+
+
+def _runner_worker(opts, controller_socket, message_socket, cpu):
+    # Entry point of each worker process started by _multi_process_runner
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    setup_logging(opts)
+    configure_python_path(opts)
+    # Workers poll the supervisor, it's local so there's nothing to gain from pushing
+    opts = dict(opts, **{'--processes': '1', '--subscribe': False, '--runner-weight': None, '--controller-socket': controller_socket, '--message-socket': message_socket})
+    runner(opts)
+
+
+def _multi_process_runner(opts, num_processes):
+    upstream_transport = _create_runner_transport(opts)
+    tmp_dir = tempfile.mkdtemp(prefix='mite-runner-')
+    controller_socket = 'ipc://%s' % (os.path.join(tmp_dir, 'controller'),)
+    message_socket = opts['--message-socket']
+    if opts['--message-backend'] == 'ZMQ':
+        # One upstream connection for the host rather than one per worker
+        from .zmq import Forwarder
+        message_socket = 'ipc://%s' % (os.path.join(tmp_dir, 'messages'),)
+        Forwarder(message_socket, opts['--message-socket']).start()
+    loop = asyncio.get_event_loop()
+    supervisor = RunnerSupervisor(upstream_transport, loop_wait=float(opts['--max-loop-delay']),
+                                  weight=_runner_weight(opts), loop=loop)
+    server = _msg_backend_module(opts).ControllerServer(controller_socket)
+    workers = WorkerProcesses(_runner_worker, (opts, controller_socket, message_socket), num_processes)
+    workers.start()
+    def restart_dead_workers():
+        if not supervisor.stopping:
+            workers.restart_dead()
+            loop.call_later(1, restart_dead_workers)
+    loop.call_later(1, restart_dead_workers)
+    loop.run_until_complete(supervisor.run(server))
+    workers.join()
 
 
 def runner(opts):
+    num_processes = int(opts.get('--processes') or 1)
+    if num_processes != 1:
+        _multi_process_runner(opts, num_processes or os.cpu_count())
+        return
     transport = _create_runner_transport(opts)
     sender = _create_sender(opts)
-    asyncio.get_event_loop().run_until_complete(_create_runner(opts, transport, sender.send).run())
+    loop = asyncio.get_event_loop()
+    _schedule_sender_report(sender, loop)
+    loop.run_until_complete(_create_runner(opts, transport, sender.send).run())
+    sender.flush()
 
 
 def collector(opts):
     receiver = _collector_receiver(opts)
     collector = Collector(opts['--collector-dir'], int(opts['--collector-role']))
-    receiver.add_listener(collector.process_message)
+    # The collector decodes the frames itself, to count messages and pick out data_created
     receiver.add_raw_listener(collector.process_raw_message)
     asyncio.get_event_loop().run_until_complete(receiver.run())
 
 
 def duplicator(opts):
     duplicator = _create_duplicator(opts)
-    asyncio.get_event_loop().run_until_complete(duplicator.run())
+    loop = asyncio.get_event_loop()
+    def duplicator_report():
+        for address, depth, dropped in duplicator.output_stats():
+            logger.info('duplicator output %s queue_depth=%d dropped=%d', address, depth, dropped)
+        loop.call_later(10, duplicator_report)
+    loop.call_later(10, duplicator_report)
+    loop.run_until_complete(duplicator.run())
 
 
 def stats(opts):
@@ -2,12 +2,30 @@ import time
 import os
 from itertools import count
 import logging
-from .utils import pack_msg
+from .utils import pack_msg, StreamDecoder
 
 
 logger = logging.getLogger(__name__)
 
 
+def _segment_sort_key(fn):
+    start_time, end_time, counter = fn.split('_')
+    return int(start_time), int(end_time), int(counter)
+
+
+def iter_collected_messages(target_dir):
+    """Yield every message a Collector wrote to target_dir, oldest segment file first"""
+    segments = sorted((fn for fn in os.listdir(target_dir) if fn.count('_') == 2 and fn.replace('_', '').isdigit()),
+                      key=_segment_sort_key)
+    segments.append('current')
+    # One decoder for every segment, compact header definitions may be in an earlier file than their use
+    decoder = StreamDecoder()
+    for fn in segments:
+        path = os.path.join(target_dir, fn)
+        if os.path.isfile(path):
+            yield from decoder.decode_file(path)
+
+
 class Collector:
     def __init__(self, target_dir=None, roll_after_n_messages=100000):
         if target_dir is None:
@@ -33,14 +51,18 @@ class Collector:
         with open(self._current_st_fn, 'w') as f:
             f.write(str(int(time.time())))
         self._current = open(self._current_fn, 'wb')
+        self._decoder = StreamDecoder()
         self._msg_count = 0
         self._tps_start = time.time()
         self._tps_count = 0
 
     def process_raw_message(self, raw):
-        self._msg_count += 1
+        """Writes a frame as received, files roll by the messages in them rather than the frames"""
         self._current.write(raw)
-        if self._msg_count == self._roll_after_n_messages:
+        for msg in self._decoder.decode_frame(raw):
+            self._msg_count += 1
+            self.process_message(msg)
+        if self._msg_count >= self._roll_after_n_messages:
             self._msg_count = 0
             self._current.close()
             with open(self._current_st_fn) as f:
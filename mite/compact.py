@@ -0,0 +1,121 @@
+from collections import deque
+from itertools import count
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+# Compact records are tuples whose first item is one of these codes. Every compact frame starts with a
+# _SENDER record naming the sender, header ids are only unique per sender.
+#   (_SENDER, sender_key)
+#   (_DEFINE, header_id, header_values)
+#   (_GENERIC, header_id, time, type, other_fields_dict)
+#   (code, header_id, time, *MESSAGE_SCHEMAS[type])
+_SENDER = 0
+_DEFINE = 1
+_GENERIC = 2
+
+HEADER_KEYS = ('test', 'runner_id', 'journey', 'context_id', 'scenario_id', 'scenario_data_id', 'transaction')
+
+MESSAGE_SCHEMAS = {
+    'start': ('intended_time',),
+    'end': ('duration', 'corrected_duration'),
+    'exception': ('message', 'ex_type', 'location', 'stacktrace'),
+    'http_curl_metrics': ('start_time', 'effective_url', 'response_code', 'dns_time', 'connect_time', 'tls_time',
+                          'transfer_start_time', 'first_byte_time', 'total_time', 'corrected_total_time', 'primary_ip',
+                          'method'),
+}
+
+_SCHEMA_CODES = {msg_type: code for code, msg_type in enumerate(sorted(MESSAGE_SCHEMAS), 3)}
+_SCHEMAS_BY_CODE = {code: (msg_type, MESSAGE_SCHEMAS[msg_type]) for msg_type, code in _SCHEMA_CODES.items()}
+
+
+def is_compact_record(obj):
+    return type(obj) is tuple and len(obj) > 1 and type(obj[0]) is int
+
+
+class CompactEncoder:
+    """Turns messages carrying the context headers into compact records
+
+    Each distinct set of header values is sent once as a definition and later messages refer to it by
+    id. Both ends forget the oldest definition once there are more than max_headers, in the order they
+    were defined, so the receiver's table always matches the sender's.
+    """
+    def __init__(self, max_headers=4096):
+        self._key = random.getrandbits(32)
+        self._max_headers = max_headers
+        self._header_ids = {}
+        self._header_order = deque()
+        self._header_id_gen = count(1)
+
+    def reset(self):
+        """Forget every definition so they are sent again, for when a frame holding some was lost"""
+        self._header_ids.clear()
+        self._header_order.clear()
+
+    def frame_start(self):
+        return (_SENDER, self._key)
+
+    def _header_id(self, header, records):
+        header_id = self._header_ids.get(header)
+        if header_id is None:
+            header_id = next(self._header_id_gen)
+            self._header_ids[header] = header_id
+            self._header_order.append(header)
+            if len(self._header_order) > self._max_headers:
+                del self._header_ids[self._header_order.popleft()]
+            records.append((_DEFINE, header_id, header))
+        return header_id
+
+    def encode(self, msg):
+        try:
+            header = tuple([msg[key] for key in HEADER_KEYS])
+            msg_type = msg['type']
+            t = msg['time']
+        except KeyError:
+            return [msg]
+        records = []
+        header_id = self._header_id(header, records)
+        fields = MESSAGE_SCHEMAS.get(msg_type)
+        if fields is not None and len(msg) == len(HEADER_KEYS) + 2 + len(fields) and all(f in msg for f in fields):
+            records.append((_SCHEMA_CODES[msg_type], header_id, t) + tuple([msg[f] for f in fields]))
+        else:
+            other = {k: v for k, v in msg.items() if k not in HEADER_KEYS and k != 'type' and k != 'time'}
+            records.append((_GENERIC, header_id, t, msg_type, other))
+        return records
+
+
+class CompactDecoder:
+    def __init__(self, max_headers=4096):
+        self._max_headers = max_headers
+        self._senders = {}
+        self._headers = None
+
+    def decode(self, obj):
+        """Returns the message dict for obj or None if obj was a control record"""
+        if not is_compact_record(obj):
+            return obj
+        code = obj[0]
+        if code == _SENDER:
+            self._headers = self._senders.setdefault(obj[1], {})
+            return None
+        if code == _DEFINE:
+            self._headers[obj[1]] = dict(zip(HEADER_KEYS, obj[2]))
+            if len(self._headers) > self._max_headers:
+                del self._headers[next(iter(self._headers))]
+            return None
+        try:
+            msg = dict(self._headers[obj[1]])
+        except (KeyError, TypeError):
+            # Missed the definition, e.g. connected after the sender started or reading a rolled file
+            logger.debug('Dropping compact record with unknown header id %r', obj[1])
+            return None
+        msg['time'] = obj[2]
+        if code == _GENERIC:
+            msg.update(obj[4])
+            msg['type'] = obj[3]
+        else:
+            msg_type, fields = _SCHEMAS_BY_CODE[code]
+            msg['type'] = msg_type
+            msg.update(zip(fields, obj[3:]))
+        return msg
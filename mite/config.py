@@ -26,6 +26,9 @@ class ConfigManager:
         self._runner_version_map[runner_id] = self._version
         return list(self._get_changes_since(version))
 
+    def has_changes_for_runner(self, runner_id):
+        return self._runner_version_map.get(runner_id, 0) < self._version
+
     def set(self, name, value):
         self._version = next(self._version_id_gen)
         self._config[name] = (value, self._version)
@@ -80,12 +80,19 @@ class Context:
         self._id_data = id_data
         self._should_stop_func = should_stop_func
         self._transaction_names = []
+        self._transaction_starts = []
+        self._start_lag = 0
         self._debug = debug
 
     @property
     def config(self):
         return self._config
 
+    @property
+    def start_lag(self):
+        """How long after its intended start the journey started, add to latencies to correct for it"""
+        return self._start_lag
+
     @property
     def should_stop(self):
         if self._should_stop_func is not None:
@@ -138,13 +145,18 @@ class Context:
         msg = {}
         self._transaction_names.append(name)
         self._add_context_headers_and_time(msg)
+        self._transaction_starts.append(msg['time'])
         msg['type'] = 'start'
+        msg['intended_time'] = msg['time'] - self._start_lag
         self._send(msg)
 
     def _end_transaction(self):
         msg= {}
         self._add_context_headers_and_time(msg)
         msg['type'] = 'end'
+        duration = msg['time'] - self._transaction_starts.pop()
+        msg['duration'] = duration
+        msg['corrected_duration'] = duration + self._start_lag
         self._send(msg)
         name = self._transaction_names.pop()
 
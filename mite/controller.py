@@ -1,4 +1,4 @@
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from itertools import count
 import time
 import logging
@@ -10,6 +10,7 @@ class WorkTracker:
     def __init__(self):
         self._all_work = defaultdict(lambda :defaultdict(int))
         self._total_work = defaultdict(int)
+        self._runner_totals = defaultdict(int)
 
     def set_actual(self, runner_id, work):
         for k, v in self._all_work[runner_id].items():
@@ -17,69 +18,156 @@ class WorkTracker:
         for k, v in work.items():
             self._total_work[k] += v
         self._all_work[runner_id] = defaultdict(int, work)
+        self._runner_totals[runner_id] = sum(work.values())
 
     def add_assumed(self, runner_id, work):
         current = self._all_work[runner_id]
         for k, v in work.items():
             current[k] += v
             self._total_work[k] += v
+            self._runner_totals[runner_id] += v
     
-    def get_total_work(self, runner_ids):
-        for expired_runner_id in set(self._all_work.keys()) - set(runner_ids):
-            self.remove_runner(expired_runner_id)
+    def get_total_work(self):
         return self._total_work
 
     def get_runner_total(self, runner_id):
-        return sum(self._all_work[runner_id].values())
+        return self._runner_totals.get(runner_id, 0)
 
     def remove_runner(self, runner_id):
-        for k, v in self._all_work[runner_id].items():
+        for k, v in self._all_work.pop(runner_id, {}).items():
             self._total_work[k] -= v
-        del self._all_work[runner_id]
+        self._runner_totals.pop(runner_id, None)
 
 
 class RunnerTracker:
+    """Runners are kept in the order they were last seen so the ones due to expire are always at the front
+
+    Hits are counted in one second buckets for the hit rate.
+    """
     def __init__(self, timeout=10):
-        self._hits = deque()
-        self._last_seen = {}
+        self._last_seen = OrderedDict()
+        self._hit_buckets = deque()
+        self._hit_count = 0
         self._timeout = timeout
 
     def update(self, runner_id):
         t = time.time()
         self._last_seen[runner_id] = t
-        self._hits.append(t)
-        if self._hits[0] < t - self._timeout:
-            self._hits.popleft()
+        self._last_seen.move_to_end(runner_id)
+        second = int(t)
+        if self._hit_buckets and self._hit_buckets[-1][0] == second:
+            self._hit_buckets[-1][1] += 1
+        else:
+            self._hit_buckets.append([second, 1])
+        self._hit_count += 1
+        self._expire_hits(t)
+
+    def _expire_hits(self, t):
+        while self._hit_buckets and self._hit_buckets[0][0] + 1 <= t - self._timeout:
+            self._hit_count -= self._hit_buckets.popleft()[1]
 
     def get_hit_rate(self):
-        t = time.time()
-        while self._hits and self._hits[0] <  t - self._timeout:
-            self._hits.popleft()
-        return len(self._hits) / self._timeout
+        self._expire_hits(time.time())
+        return self._hit_count / self._timeout
+
+    def pop_expired(self):
+        """Forgets runners not seen within the timeout and returns their ids"""
+        expiry = time.time() - self._timeout
+        expired = []
+        while self._last_seen:
+            runner_id, last_seen = next(iter(self._last_seen.items()))
+            if last_seen > expiry:
+                break
+            del self._last_seen[runner_id]
+            expired.append(runner_id)
+        return expired
 
     def remove_runner(self, runner_id):
-        del self._last_seen[runner_id]
+        self._last_seen.pop(runner_id, None)
 
     def get_active(self):
-        t = time.time()
-        return [k for k, v in self._last_seen.items() if v + self._timeout > t]
+        """Runners seen within the timeout as of the last pop_expired"""
+        return self._last_seen.keys()
 
     def get_active_count(self):
-        return len(self.get_active())
+        return len(self._last_seen)
+
+
+class RunnerWeights:
+    """Each runner's part of the volume by its weight, totals are kept as runners come and go
+
+    Runners without a weight count as the average of those with one, when none have one the volume is
+    split evenly.
+    """
+    def __init__(self):
+        self._weights = {}
+        self._known_total = 0
+        self._known_count = 0
+
+    def set(self, runner_id, weight):
+        if runner_id in self._weights:
+            if self._weights[runner_id] == weight:
+                return
+            self.remove(runner_id)
+        self._weights[runner_id] = weight
+        if weight is not None:
+            self._known_total += weight
+            self._known_count += 1
+
+    def remove(self, runner_id):
+        if runner_id not in self._weights:
+            return
+        weight = self._weights.pop(runner_id)
+        if weight is not None:
+            self._known_total -= weight
+            self._known_count -= 1
+
+    def __len__(self):
+        return len(self._weights)
+
+    def fraction(self, runner_id):
+        """None means share evenly"""
+        if not self._known_count or runner_id not in self._weights:
+            return None
+        average = self._known_total / self._known_count
+        total = self._known_total + average * (len(self._weights) - self._known_count)
+        if total <= 0:
+            return None
+        weight = self._weights[runner_id]
+        if weight is None:
+            weight = average
+        return weight / total
 
 
 class Controller:
-    def __init__(self, testname, scenario_manager, config_manager):
+    def __init__(self, testname, scenario_manager, config_manager, runner_max_lag=None):
         self._testname = testname
         self._scenario_manager = scenario_manager
         self._runner_id_gen = count(1)
         self._work_tracker = WorkTracker()
         self._runner_tracker = RunnerTracker()
         self._config_manager = config_manager
+        self._runner_stats = {}
+        self._lagging_runners = set()
+        self._data_leases = defaultdict(set)
+        self._data_reclaimed = defaultdict(int)
+        self._data_leaked = defaultdict(int)
+        self._runner_max_lag = runner_max_lag
+        self._runner_advertised_weights = {}
+        self._runner_weights = RunnerWeights()
+        self._subscribers = {}
+        self._stop_pushed = set()
+        self._last_push_time = None
+        self._push_offset = 0
 
-    def hello(self):
+    def hello(self, weight=None):
         runner_id = next(self._runner_id_gen)
-        return runner_id, self._testname, self._config_manager.get_changes_for_runner(runner_id)
+        self._runner_tracker.update(runner_id)
+        self._runner_advertised_weights[runner_id] = weight
+        # Counted straight away so everyone else's share shrinks before the newcomer even asks for work
+        self._runner_weights.set(runner_id, weight)
+        return (runner_id, self._testname, self._config_manager.get_changes_for_runner(runner_id),
+                self._scenario_manager.get_partitioned_scenario_ids())
 
     def _set_actual(self, runner_id, current_work):
         self._work_tracker.set_actual(runner_id, current_work)
@@ -87,40 +175,188 @@ class Controller:
     def _add_assumed(self, runner_id, work):
         self._work_tracker.add_assumed(runner_id, work)
     
-    def _required_work_for_runner(self, runner_id, max_work=None):
+    def _is_lagging(self, runner_id):
+        return runner_id in self._lagging_runners
+
+    def _expire_runners(self):
+        for runner_id in self._runner_tracker.pop_expired():
+            if runner_id in self._subscribers:
+                logger.warning('Subscribed runner %s has timed out, forgetting it', runner_id)
+                del self._subscribers[runner_id]
+            # The advertised weight is kept in case the runner comes back
+            self._work_tracker.remove_runner(runner_id)
+            self._runner_stats.pop(runner_id, None)
+            self._lagging_runners.discard(runner_id)
+            self._runner_weights.remove(runner_id)
+            self._scenario_manager.release_data(runner_id)
+            self._reclaim_data(runner_id)
+
+    def _checkin_data(self, runner_id, completed_data_ids):
+        leases = self._data_leases.get(runner_id, ())
+        checked_in = []
+        for scenario_id, scenario_data_id in completed_data_ids:
+            if (scenario_id, scenario_data_id) in leases:
+                leases.remove((scenario_id, scenario_data_id))
+                checked_in.append((scenario_id, scenario_data_id))
+            else:
+                # Taken back when the runner timed out, checking it in again would put it in the pool twice
+                logger.debug('Runner %s completed data %r of scenario %r it no longer held', runner_id,
+                             scenario_data_id, scenario_id)
+        self._scenario_manager.checkin_data(checked_in)
+
+    def _reclaim_data(self, runner_id):
+        leases = self._data_leases.pop(runner_id, None)
+        if not leases:
+            return
+        logger.warning('Runner %s went away holding %d data items, checking them back in', runner_id, len(leases))
+        checked_in = self._scenario_manager.checkin_data(leases)
+        for scenario_id, scenario_data_id in leases:
+            if (scenario_id, scenario_data_id) in checked_in:
+                self._data_reclaimed[scenario_id] += 1
+            else:
+                self._data_leaked[scenario_id] += 1
+
+    def _update_runner(self, runner_id, max_work, runner_stats):
+        self._runner_tracker.update(runner_id)
+        if runner_stats is not None:
+            self._runner_stats[runner_id] = runner_stats
+            if self._runner_max_lag is not None and runner_stats.get('loop_lag', 0) > self._runner_max_lag:
+                self._lagging_runners.add(runner_id)
+            else:
+                self._lagging_runners.discard(runner_id)
+        if self._is_lagging(runner_id):
+            self._runner_weights.remove(runner_id)
+        else:
+            # An advertised weight wins over the capacity the runner reports as max_work
+            weight = self._runner_advertised_weights.get(runner_id)
+            if weight is None:
+                weight = max_work
+            self._runner_weights.set(runner_id, weight)
+
+    def _required_work_for_runner(self, runner_id, max_work=None, hit_rate=None):
+        if self._is_lagging(runner_id):
+            # Its latencies are already suspect, more work would only make that worse
+            logger.debug('Runner %s loop lag is over %ss, not giving it work', runner_id, self._runner_max_lag)
+            return []
         runner_total = self._work_tracker.get_runner_total(runner_id)
-        active_runner_ids = self._runner_tracker.get_active()
-        current_work = self._work_tracker.get_total_work(active_runner_ids)
-        hit_rate = self._runner_tracker.get_hit_rate()
-        work, scenario_volume_map = self._scenario_manager.get_work(current_work, runner_total, len(active_runner_ids), max_work, hit_rate)
+        current_work = self._work_tracker.get_total_work()
+        if hit_rate is None:
+            hit_rate = self._runner_tracker.get_hit_rate()
+        num_runners = max(1, len(self._runner_weights))
+        work, scenario_volume_map = self._scenario_manager.get_work(current_work, runner_total, num_runners, max_work, hit_rate,
+                                                                    self._runner_weights.fraction(runner_id))
         self._add_assumed(runner_id, scenario_volume_map) 
+        leases = self._data_leases[runner_id]
+        for scenario_id, scenario_data_id, journey_spec, args, start_delay in work:
+            if scenario_data_id is not None:
+                leases.add((scenario_id, scenario_data_id))
         return work
 
-    def request_work(self, runner_id, current_work, completed_data_ids, max_work=None):
+    def request_work(self, runner_id, current_work, completed_data_ids, max_work=None, runner_stats=None):
+        self._expire_runners()
         self._set_actual(runner_id, current_work)
-        self._runner_tracker.update(runner_id)
-        self._scenario_manager.checkin_data(completed_data_ids)
+        self._update_runner(runner_id, max_work, runner_stats)
+        self._checkin_data(runner_id, completed_data_ids)
         work = self._required_work_for_runner(runner_id, max_work)
         return work, self._config_manager.get_changes_for_runner(runner_id), not self._scenario_manager.is_active()
 
+    def subscribe(self, runner_id, max_work=None):
+        self._expire_runners()
+        self._update_runner(runner_id, max_work, None)
+        self._subscribers[runner_id] = max_work
+
+    def report_work(self, runner_id, current_work, completed_data_ids, max_work=None, runner_stats=None):
+        self._expire_runners()
+        self._set_actual(runner_id, current_work)
+        self._update_runner(runner_id, max_work, runner_stats)
+        self._checkin_data(runner_id, completed_data_ids)
+        if runner_id in self._subscribers:
+            self._subscribers[runner_id] = max_work
+        return not self._scenario_manager.is_active()
+
+    def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        """Takes back the returned shard_id, remaining_ids pairs and, if lease, returns a new shard or None"""
+        return self._scenario_manager.lease_data(runner_id, scenario_id, returned, lease)
+
+    def _is_short_of_work(self):
+        required = self._scenario_manager.get_required_work()
+        current_work = self._work_tracker.get_total_work()
+        return any(current_work.get(scenario_id, 0) < number for scenario_id, number in required.items())
+
+    def get_pushes(self):
+        """Returns (runner_id, (work, config_list, stop)) for each subscribed runner with something to push
+
+        Called often, it's cheap when volume is already met. The spawn rate is split over the calls the
+        same way it is split over requests from polling runners.
+        """
+        if not self._subscribers:
+            return []
+        self._expire_runners()
+        t = time.time()
+        hit_rate = None
+        if self._last_push_time is not None and t > self._last_push_time:
+            hit_rate = len(self._subscribers) / (t - self._last_push_time)
+        self._last_push_time = t
+        # Checking for a shortfall updates the required volume, which is what ends scenarios
+        short = self._is_short_of_work() or bool(self._scenario_manager.get_arrival_rates())
+        stop = not self._scenario_manager.is_active()
+        pushes = []
+        # Whoever is asked first gets the arrivals that have come due since the last call, take turns
+        runner_ids = list(self._subscribers)
+        self._push_offset = (self._push_offset + 1) % len(runner_ids) if runner_ids else 0
+        for runner_id in runner_ids[self._push_offset:] + runner_ids[:self._push_offset]:
+            max_work = self._subscribers[runner_id]
+            work = []
+            if short and not stop:
+                work = self._required_work_for_runner(runner_id, max_work, hit_rate)
+            config_list = []
+            if self._config_manager.has_changes_for_runner(runner_id):
+                config_list = self._config_manager.get_changes_for_runner(runner_id)
+            if stop and runner_id not in self._stop_pushed:
+                self._stop_pushed.add(runner_id)
+            elif not work and not config_list:
+                continue
+            pushes.append((runner_id, (work, config_list, stop)))
+        return pushes
+
     def report(self, sender):
+        self._expire_runners()
         required = self._scenario_manager.get_required_work()
-        active_runner_ids = self._runner_tracker.get_active()
-        actual = self._work_tracker.get_total_work(active_runner_ids)
+        actual = self._work_tracker.get_total_work()
+        worker_work = {}
+        for runner_stats in self._runner_stats.values():
+            worker_work.update(runner_stats.get('worker_work', {}))
         sender({
             'type': 'controller_report', 
             'time': time.time(),
             'test': self._testname,
             'required': required, 
             'actual': actual, 
-            'num_runners': len(active_runner_ids)
+            'num_runners': self._runner_tracker.get_active_count(),
+            'num_lagging_runners': len(self._lagging_runners),
+            'worker_work': worker_work,
+            'arrival_rates': self._scenario_manager.get_arrival_rates(),
+            'skipped_arrivals': self._scenario_manager.pop_skipped_arrivals(),
+            'data_reclaimed': dict(self._data_reclaimed),
+            'data_leaked': dict(self._data_leaked)
         })
+        self._data_reclaimed.clear()
+        self._data_leaked.clear()
 
     def should_stop(self):
+        self._expire_runners()
         return (not self._scenario_manager.is_active()) and self._runner_tracker.get_active_count() == 0
 
     def bye(self, runner_id):
         self._runner_tracker.remove_runner(runner_id)
         self._work_tracker.remove_runner(runner_id)
+        self._runner_stats.pop(runner_id, None)
+        self._lagging_runners.discard(runner_id)
+        self._runner_advertised_weights.pop(runner_id, None)
+        self._runner_weights.remove(runner_id)
+        self._subscribers.pop(runner_id, None)
+        self._stop_pushed.discard(runner_id)
+        self._scenario_manager.release_data(runner_id)
+        self._reclaim_data(runner_id)
 
 
@@ -1,8 +1,18 @@
-from collections import namedtuple, deque
-from itertools import count
+from array import array
+import atexit
+from collections import namedtuple, deque, defaultdict
+from itertools import count, islice
+import csv
+import json
 import logging
+import mmap
+import msgpack
+import os
 import random
-from .utils import spec_import
+import sqlite3
+import struct
+import threading
+from .utils import spec_import, pack_msg, unpack_msg
 
 
 logger = logging.getLogger(__name__)
@@ -28,44 +38,54 @@ class RecyclableIterableDataPool:
         else:
             return None
 
+    def checkout_many(self, n):
+        """Returns up to n items, fewer if there aren't that many available"""
+        dpis = []
+        for _ in range(min(n, len(self._available))):
+            dpi = self._available.popleft()
+            self._checked_out[dpi.id] = dpi.data
+            dpis.append(dpi)
+        return dpis
+
     def checkin(self, id):
         data = self._checked_out[id]
         self._available.append(DataPoolItem(id, data))
 
 
 class IterableFactoryDataPool:
+    """Items come from the factory on first checkout, after that free ids are kept in checkin order"""
     def __init__(self, iterable_factory):
         self._iterable_factory = iterable_factory
+        self._items = None
+        self._free = None
         self._checked_out = set()
-    
-    def _cycle(self):
-        counter = count(1)
-        _iter = iter(self._iterable_factory())
-        while True:
-            try:
-                data = next(_iter)
-            except StopIteration:
-                counter = count(1)
-                _iter = iter(self._iterable_factory())
-                data = next(_iter)
-            _id = next(counter)
-            yield _id, data
+
+    def _materialize(self):
+        self._items = list(self._iterable_factory())
+        self._free = deque(range(1, len(self._items) + 1))
 
     def checkout(self):
-        if not hasattr(self, '_cycle_gen_iter'):
-            self._cycle_gen_iter = self._cycle()
-        last_id = 0
-        while True:
-            _id, data = next(self._cycle_gen_iter)
-            if _id not in self._checked_out:
-                self._checked_out.add(_id)
-                return DataPoolItem(_id, data)
-            if _id <= last_id:
-                return None
-            last_id = _id
-    
+        if self._items is None:
+            self._materialize()
+        if not self._free:
+            return None
+        _id = self._free.popleft()
+        self._checked_out.add(_id)
+        return DataPoolItem(_id, self._items[_id - 1])
+
+    def checkout_many(self, n):
+        if self._items is None:
+            self._materialize()
+        dpis = []
+        for _ in range(min(n, len(self._free))):
+            _id = self._free.popleft()
+            self._checked_out.add(_id)
+            dpis.append(DataPoolItem(_id, self._items[_id - 1]))
+        return dpis
+
     def checkin(self, id):
         self._checked_out.remove(id)
+        self._free.append(id)
 
 
 class IterableDataPool:
@@ -82,11 +102,406 @@ class IterableDataPool:
             id = next(self._id_gen)
             dpi = DataPoolItem(id, data)
             return dpi
+
+    def checkout_many(self, n):
+        """Raises DataPoolExhausted only once there is nothing left to return"""
+        dpis = [DataPoolItem(next(self._id_gen), data) for data in islice(self._iter, n)]
+        if n and not dpis:
+            raise DataPoolExhausted()
+        return dpis
  
     def checkin(self, id):
         pass
 
 
+_INDEX_MAGIC = b'MIDX'
+_INDEX_HEADER = struct.Struct('<4s4sQQQ')
+_FILE_FORMATS = {
+    '.jsonl': b'json',
+    '.ndjson': b'json',
+    '.csv': b'csv ',
+    '.msgpack': b'mpk ',
+    '.mp': b'mpk ',
+}
+
+
+def _line_offsets(mm, start=0):
+    offsets = array('Q')
+    size = len(mm)
+    while start < size:
+        end = mm.find(b'\n', start)
+        if end == -1:
+            end = size
+        if mm[start:end].strip():
+            offsets.append(start)
+        start = end + 1
+    offsets.append(size)
+    return offsets
+
+
+def _msgpack_offsets(path):
+    offsets = array('Q', [0])
+    with open(path, 'rb') as f:
+        unpacker = msgpack.Unpacker(f)
+        while True:
+            try:
+                unpacker.skip()
+            except msgpack.OutOfData:
+                break
+            offsets.append(unpacker.tell())
+    return offsets
+
+
+class FileDataPool:
+    """Data pool read lazily from a JSON lines, CSV or msgpack file, each record being a journey's args
+
+    Records are found through an index of their offsets kept next to the file, built on first use
+    and rebuilt when the file changes, so reopening a large file is quick and only the records in use are decoded.
+    Items are handed out in file order and, with recycle, checked in items go round again after the rest like
+    RecyclableIterableDataPool. Without recycle each record is used once and then DataPoolExhausted is raised.
+    JSON lines and CSV records can't contain newlines, set header for a CSV file with a header row.
+    """
+    def __init__(self, path, recycle=True, header=False, index_path=None):
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in _FILE_FORMATS:
+            raise ValueError('Unknown data file type %r, expected one of %r' % (ext, sorted(_FILE_FORMATS)))
+        self._path = path
+        self._format = _FILE_FORMATS[ext]
+        self._recycle = recycle
+        self._header = header
+        self._index_path = index_path or path + '.idx'
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        self._offsets = self._load_index()
+        if self._offsets is None:
+            self._offsets = self._build_index()
+        # The last offset is the end of the file
+        self._size = len(self._offsets) - 1
+        self._cursor = 0
+        self._returned = deque()
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return 'FileDataPool(%r, recycle=%r)' % (self._path, self._recycle)
+
+    def _index_key(self):
+        stat = os.stat(self._path)
+        return self._format, stat.st_size, stat.st_mtime_ns, int(self._header)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'rb') as f:
+                index_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(index_mm) < _INDEX_HEADER.size:
+            return None
+        magic, _format, size, mtime_ns, header = _INDEX_HEADER.unpack_from(index_mm)
+        if magic != _INDEX_MAGIC or (_format, size, mtime_ns, header) != self._index_key():
+            logger.info('Data file %s has changed, rebuilding its index', self._path)
+            return None
+        return memoryview(index_mm)[_INDEX_HEADER.size:].cast('Q')
+
+    def _build_index(self):
+        logger.info('Indexing data file %s', self._path)
+        if self._format == b'mpk ':
+            offsets = _msgpack_offsets(self._path)
+        else:
+            start = 0
+            if self._header:
+                start = self._mm.find(b'\n') + 1 or len(self._mm)
+            offsets = _line_offsets(self._mm, start)
+        tmp_path = self._index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, *self._index_key()))
+                offsets.tofile(f)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning('Could not save the index of data file %s, it will be rebuilt next time: %s', self._path, e)
+        return offsets
+
+    def _decode(self, id):
+        start, end = self._offsets[id - 1], self._offsets[id]
+        if self._format == b'mpk ':
+            return unpack_msg(self._mm[start:end])
+        newline = self._mm.find(b'\n', start, end)
+        raw = self._mm[start:end if newline == -1 else newline]
+        if self._format == b'json':
+            return json.loads(raw.decode('utf-8'))
+        return next(csv.reader([raw.decode('utf-8').rstrip('\r')]))
+
+    def checkout(self):
+        dpis = self.checkout_many(1)
+        return dpis[0] if dpis else None
+
+    def checkout_many(self, n):
+        dpis = []
+        while len(dpis) < n:
+            if self._cursor < self._size:
+                self._cursor += 1
+                id = self._cursor
+            elif self._returned:
+                id = self._returned.popleft()
+            elif self._recycle or dpis:
+                break
+            else:
+                raise DataPoolExhausted()
+            dpis.append(DataPoolItem(id, self._decode(id)))
+        return dpis
+
+    def checkin(self, id):
+        if self._recycle:
+            self._returned.append(id)
+
+
+_FREE = 0
+_CLAIMED = 1
+_CONSUMED = 2
+
+
+class SQLiteDataPool:
+    """Consume once data pool kept in a SQLite database so a restarted test carries on where it left off
+
+    The database is filled from iterable the first time, after that iterable is ignored. Rows are claimed in
+    blocks by a background thread before they are needed and consumed rows are recorded in batches, so checkout
+    and checkin don't touch the disk. A claimed row is never handed out again, so rows claimed or checked out
+    when the process died are skipped on resume unless resume_checked_out is set, and at most flush_interval
+    of checkins are lost, those rows count as claimed.
+    """
+    def __init__(self, path, iterable=None, block_size=1000, batch_size=1000, flush_interval=1,
+                 resume_checked_out=False):
+        self._path = path
+        self._block_size = block_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, data BLOB, state INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS free_items ON items (id) WHERE state = %d' % (_FREE,))
+        self._lock = threading.Lock()
+        if self._conn.execute('SELECT EXISTS (SELECT 1 FROM items)').fetchone()[0]:
+            if resume_checked_out:
+                self._conn.execute('UPDATE items SET state = ? WHERE state = ?', (_FREE, _CLAIMED))
+            logger.info('Resuming data pool %s', path)
+        elif iterable is not None:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT INTO items (data, state) VALUES (?, %d)' % (_FREE,),
+                                   ((pack_msg(data),) for data in iterable))
+            self._conn.execute('COMMIT')
+        self._ready = deque()
+        self._consumed = deque()
+        self._last_id = 0
+        self._all_claimed = False
+        self._closed = False
+        self._fetch()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='mite.datapool %s' % (path,))
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return 'SQLiteDataPool(%r)' % (self._path,)
+
+    def _fetch(self):
+        with self._lock:
+            if self._all_claimed:
+                return
+            # The state is in the SQL rather than a parameter so SQLite can use the partial index
+            self._conn.execute('BEGIN IMMEDIATE')
+            rows = self._conn.execute('SELECT id, data FROM items WHERE state = %d AND id > ? ORDER BY id LIMIT ?' % (
+                _FREE,), (self._last_id, self._block_size)).fetchall()
+            if rows:
+                self._conn.execute('UPDATE items SET state = %d WHERE state = %d AND id BETWEEN ? AND ?' % (
+                    _CLAIMED, _FREE), (rows[0][0], rows[-1][0]))
+            self._conn.execute('COMMIT')
+            if rows:
+                self._last_id = rows[-1][0]
+            # Decoded here so checkout doesn't have to
+            self._ready.extend(DataPoolItem(id, unpack_msg(data)) for id, data in rows)
+            if len(rows) < self._block_size:
+                self._all_claimed = True
+
+    def _flush(self):
+        consumed = []
+        while self._consumed:
+            consumed.append((self._consumed.popleft(),))
+        if consumed:
+            with self._lock:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('UPDATE items SET state = %d WHERE id = ?' % (_CONSUMED,), consumed)
+                self._conn.execute('COMMIT')
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            if self._closed:
+                break
+            if len(self._ready) < self._block_size:
+                self._fetch()
+            self._flush()
+
+    def checkout(self):
+        dpis = self.checkout_many(1)
+        return dpis[0] if dpis else None
+
+    def checkout_many(self, n):
+        dpis = []
+        while len(dpis) < n and self._ready:
+            dpis.append(self._ready.popleft())
+        if self._all_claimed:
+            # Rows are ready before the flag is set so once it is set an empty queue stays empty
+            if not dpis and not self._ready:
+                raise DataPoolExhausted()
+        elif len(self._ready) < self._block_size // 2:
+            self._wakeup.set()
+        return dpis
+
+    def checkin(self, id):
+        self._consumed.append(id)
+        if len(self._consumed) >= self._batch_size:
+            self._wakeup.set()
+
+    def close(self):
+        """Records what has been consumed and frees the rows claimed but not handed out"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._flush()
+        unused = []
+        while self._ready:
+            unused.append((self._ready.popleft().id,))
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('UPDATE items SET state = %d WHERE id = ?' % (_FREE,), unused)
+            self._conn.execute('COMMIT')
+            self._conn.close()
+        atexit.unregister(self.close)
+
+
+class PartitionedDataPool:
+    """Leases shards of contiguous item ids to runners, which check the items out and in themselves
+
+    Only leases and returned shards go through the controller. With recycle a runner's items go back to its
+    shard as journeys finish, otherwise each item is used once and the pool is exhausted once every shard has
+    been used up.
+    """
+    def __init__(self, iterable, shard_size=100, recycle=True):
+        self.recycle = recycle
+        self._data = list(iterable)
+        self._shards = {}
+        for shard_id, start in enumerate(range(0, len(self._data), shard_size), 1):
+            self._shards[shard_id] = list(range(start + 1, min(start + shard_size, len(self._data)) + 1))
+        self._free = deque(self._shards)
+        self._leases = {}
+
+    @property
+    def exhausted(self):
+        return not self._shards
+
+    def lease(self, runner_id):
+        """Returns shard_id, [(id, data), ...], recycle or None if every shard is leased"""
+        if not self._free:
+            return None
+        shard_id = self._free.popleft()
+        self._leases[shard_id] = runner_id
+        return shard_id, [(id, self._data[id - 1]) for id in self._shards[shard_id]], self.recycle
+
+    def release(self, runner_id, shard_id, remaining_ids=None):
+        """remaining_ids are the ids the runner didn't use, None if it couldn't say so the whole shard is reused"""
+        if self._leases.get(shard_id) != runner_id:
+            # Already taken back from a runner that timed out
+            return
+        del self._leases[shard_id]
+        if remaining_ids is not None and not self.recycle:
+            if not remaining_ids:
+                del self._shards[shard_id]
+                return
+            self._shards[shard_id] = list(remaining_ids)
+        self._free.append(shard_id)
+
+    def release_runner(self, runner_id):
+        for shard_id, lease_runner_id in list(self._leases.items()):
+            if lease_runner_id == runner_id:
+                self.release(runner_id, shard_id)
+
+
+class ShardedDataPoolProxy:
+    """A runner's side of a PartitionedDataPool, the shards it holds
+
+    A shard is handed back once it is used up, or when recycling once it is idle and the other shards have at
+    least as many items free, so a runner holds about one shard more than it needs.
+    """
+    def __init__(self):
+        self.recycle = True
+        self._shards = {}
+        self._sizes = {}
+        self._shard_ids = {}
+        self._checked_out = {}
+        self._num_checked_out = defaultdict(int)
+        self._available = 0
+        self._returned = []
+
+    def add_shard(self, shard_id, items, recycle):
+        self.recycle = recycle
+        self._shards[shard_id] = deque(DataPoolItem(id, data) for id, data in items)
+        self._sizes[shard_id] = len(items)
+        for id, data in items:
+            self._shard_ids[id] = shard_id
+        self._available += len(items)
+
+    def checkout(self):
+        for shard_id, available in self._shards.items():
+            if available:
+                dpi = available.popleft()
+                self._checked_out[dpi.id] = dpi
+                self._num_checked_out[shard_id] += 1
+                self._available -= 1
+                return dpi
+        return None
+
+    def checkin(self, id):
+        dpi = self._checked_out.pop(id)
+        shard_id = self._shard_ids[id]
+        self._num_checked_out[shard_id] -= 1
+        idle = not self._num_checked_out[shard_id]
+        if self.recycle:
+            self._shards[shard_id].append(dpi)
+            self._available += 1
+            if idle and self._available - self._sizes[shard_id] >= self._sizes[shard_id]:
+                self._return(shard_id)
+        else:
+            del self._shard_ids[id]
+            if idle and not self._shards[shard_id]:
+                self._return(shard_id)
+
+    def _return(self, shard_id):
+        available = self._shards.pop(shard_id)
+        for dpi in available:
+            del self._shard_ids[dpi.id]
+        del self._sizes[shard_id]
+        self._num_checked_out.pop(shard_id, None)
+        self._available -= len(available)
+        self._returned.append((shard_id, [dpi.id for dpi in available]))
+
+    def pop_returned(self):
+        """Returns shard_id, remaining_ids pairs for the shards handed back since last called"""
+        returned, self._returned = self._returned, []
+        return returned
+
+    def release_all(self):
+        """Hands back every shard, for when no journeys are running"""
+        for shard_id in list(self._shards):
+            self._return(shard_id)
+
+
 def create_iterable_data_pool_with_recycling(iterable):
     return RecyclableIterableDataPool(iterable)
 
@@ -1,6 +1,7 @@
 import asyncio
 
-from .datapools import RecyclableIterableDataPool
+from .datapools import RecyclableIterableDataPool, PartitionedDataPool
+from .scenario import ArrivalRate
 
 
 async def journey(ctx, arg1, arg2):
@@ -12,6 +13,10 @@ async def journey(ctx, arg1, arg2):
 datapool = RecyclableIterableDataPool([(i, i+2) for i in range(5000)])
 
 
+# Runners lease 100 items at a time and check them out and in themselves
+partitioned_datapool = PartitionedDataPool([(i, i+2) for i in range(5000)], shard_size=100)
+
+
 volumemodel = lambda start, end: 10
 
 
@@ -20,3 +25,14 @@ def scenario():
         ['mite.example:journey', datapool, volumemodel],
     ]
 
+
+def arrival_scenario():
+    return [
+        ['mite.example:journey', datapool, ArrivalRate(lambda start, end: 20)],
+    ]
+
+
+def partitioned_scenario():
+    return [
+        ['mite.example:journey', partitioned_datapool, volumemodel],
+    ]
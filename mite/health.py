@@ -0,0 +1,147 @@
+from collections import deque
+import asyncio
+import gc
+import logging
+import resource
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        # Only the peak is portable, it's better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+class HealthSampler:
+    """Measures how overloaded this process is so its latencies can be trusted or not
+
+    Loop lag is how late a callback scheduled every interval runs. GC pauses are timed with gc.callbacks.
+    """
+    def __init__(self, interval=0.1, recent=1, loop=None):
+        self._interval = interval
+        self._lags = []
+        self._recent_lags = deque(maxlen=max(1, int(recent / interval)))
+        self._recent_cpu = deque(maxlen=max(2, int(recent / interval) + 1))
+        self._gc_start = None
+        self._gc_pause = 0
+        self._gc_collections = 0
+        self._handle = None
+        self._expected = None
+        self._last_wall = None
+        self._last_cpu = None
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+    def start(self):
+        gc.callbacks.append(self._gc_callback)
+        self._last_wall = time.time()
+        self._last_cpu = time.process_time()
+        self._recent_cpu.append((self._last_wall, self._last_cpu))
+        self._expected = self._loop.time() + self._interval
+        self._handle = self._loop.call_at(self._expected, self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            self._gc_pause += time.perf_counter() - self._gc_start
+            self._gc_collections += 1
+            self._gc_start = None
+
+    def _tick(self):
+        now = self._loop.time()
+        lag = max(0, now - self._expected)
+        self._lags.append(lag)
+        self._recent_lags.append(lag)
+        self._recent_cpu.append((time.time(), time.process_time()))
+        self._expected = now + self._interval
+        self._handle = self._loop.call_at(self._expected, self._tick)
+
+    def recent_lag(self):
+        """The worst loop lag seen recently"""
+        return max(self._recent_lags, default=0)
+
+    def recent_cpu_percent(self):
+        if len(self._recent_cpu) < 2:
+            return 0
+        (first_wall, first_cpu), (last_wall, last_cpu) = self._recent_cpu[0], self._recent_cpu[-1]
+        return 100 * (last_cpu - first_cpu) / max(last_wall - first_wall, 1e-9)
+
+    def sample(self):
+        """Returns the health fields for the time since the last sample"""
+        wall = time.time()
+        cpu = time.process_time()
+        lags = sorted(self._lags)
+        health = {
+            'loop_lag_p50': _percentile(lags, 50),
+            'loop_lag_p90': _percentile(lags, 90),
+            'loop_lag_p99': _percentile(lags, 99),
+            'loop_lag_max': lags[-1] if lags else 0,
+            'cpu_percent': 100 * (cpu - self._last_cpu) / max(wall - self._last_wall, 1e-9),
+            'rss_bytes': _rss_bytes(),
+            'gc_pause': self._gc_pause,
+            'gc_collections': self._gc_collections,
+        }
+        del self._lags[:]
+        self._gc_pause = 0
+        self._gc_collections = 0
+        self._last_wall = wall
+        self._last_cpu = cpu
+        return health
+
+
+class CapacityController:
+    """Works out how many journeys a runner can run at once from its health, additive increase multiplicative decrease
+
+    Capacity doubles each period while it's being used and the runner is healthy, until the first time the
+    loop lags more than target_lag or CPU goes over max_cpu. After that it grows by increase per period and
+    is cut by decrease whenever either limit is passed again.
+    """
+    def __init__(self, sampler, target_lag=0.05, max_cpu=90, initial=10, increase=10, decrease=0.5, period=1):
+        self._sampler = sampler
+        self._target_lag = target_lag
+        self._max_cpu = max_cpu
+        self._capacity = initial
+        self._increase = increase
+        self._decrease = decrease
+        self._period = period
+        self._slow_start = True
+        self._next_update = time.monotonic() + period
+
+    def capacity(self, in_flight):
+        now = time.monotonic()
+        if now < self._next_update:
+            return self._capacity
+        self._next_update = now + self._period
+        lag = self._sampler.recent_lag()
+        cpu = self._sampler.recent_cpu_percent()
+        if lag > self._target_lag or cpu > self._max_cpu:
+            self._slow_start = False
+            self._capacity = max(1, int(self._capacity * self._decrease))
+            logger.debug('Runner capacity down to %d, loop lag %.3fs cpu %.0f%%', self._capacity, lag, cpu)
+        elif in_flight >= self._capacity * 0.8:
+            # Only grow when the capacity we have is in use, otherwise there's nothing to learn
+            if self._slow_start:
+                self._capacity *= 2
+            else:
+                self._capacity += self._increase
+        return self._capacity
@@ -2,21 +2,26 @@ import logging
 import time
 
 
+_EXCEPTION_KEYS = frozenset(['type', 'time', 'stacktrace', 'message', 'ex_type'])
+_HEADER_KEYS = frozenset(['type', 'time'])
+
+
 class MsgOutput:
     def __init__(self):
         self._logger = logging.getLogger('MSG')
-    
+
+    def _format(self, msg, skip_keys):
+        start = "[%s] %.6f" % (msg.get('type'), msg.get('time', 0))
+        end = ', '.join("%s=%r" % (k, v) for k, v in sorted(msg.items()) if k not in skip_keys)
+        return start, end
+
     def process_message(self, msg):
-        stacktrace = msg.pop('stacktrace', None)
+        stacktrace = msg.get('stacktrace')
         if stacktrace and self._logger.isEnabledFor(logging.WARNING):
-            message = msg.pop('message', None)
-            ex_type = msg.pop('ex_type', None)
-            start = "[%s] %.6f" % (msg.pop('type', None), msg.pop('time', None))
-            end = ', '.join("%s=%r" % (k, v) for k, v in sorted(msg.items()))
-            self._logger.warning("%s %s\n%s: %s\n%s", start, end, ex_type, message, stacktrace)
+            start, end = self._format(msg, _EXCEPTION_KEYS)
+            self._logger.warning("%s %s\n%s: %s\n%s", start, end, msg.get('ex_type'), msg.get('message'), stacktrace)
         elif self._logger.isEnabledFor(logging.DEBUG):
-            start = "[%s] %.6f" % (msg.pop('type', None), msg.pop('time', None))
-            end = ', '.join("%s=%r" % (k, v) for k, v in sorted(msg.items()))
+            start, end = self._format(msg, _HEADER_KEYS)
             self._logger.debug("%s %s", start, end)
 
 
@@ -30,19 +35,22 @@ class HttpStatsOutput:
         self._error_total = 0
         self._error_recent = 0
         self._resp_time_recent = []
+        self._corrected_resp_time_recent = []
 
-    def _pct(self, percentil):
-        if not self._resp_time_recent:
+    def _pct(self, percentil, values=None):
+        if values is None:
+            values = self._resp_time_recent
+        if not values:
             return "None"
         assert 0 <= percentil <= 100
-        index = ((percentil/100) * (len(self._resp_time_recent)-1))
+        index = ((percentil/100) * (len(values)-1))
         low_index = int(index)
         offset = index % 1
         if offset == 0:
-            return "%.6f" % (self._resp_time_recent[low_index],)
+            return "%.6f" % (values[low_index],)
         else:
-            a = self._resp_time_recent[low_index]
-            b = self._resp_time_recent[low_index + 1]
+            a = values[low_index]
+            b = values[low_index + 1]
             iterpalated_amount = (b - a) * offset
             return "%.6f" % (a + iterpalated_amount,)
 
@@ -72,12 +80,26 @@ class HttpStatsOutput:
                 self._pct(99.99),
                 self._pct(100)
             )
+            if self._corrected_resp_time_recent:
+                corrected = self._corrected_resp_time_recent
+                corrected.sort()
+                self._logger.info('Last %d Secs Corrected> 50%%:%s 90%%:%s 99%%:%s 99.9%%:%s max:%s',
+                    self._period,
+                    self._pct(50, corrected),
+                    self._pct(90, corrected),
+                    self._pct(99, corrected),
+                    self._pct(99.9, corrected),
+                    self._pct(100, corrected)
+                )
             self._start_t = t
             del self._resp_time_recent[:]
+            del self._corrected_resp_time_recent[:]
             self._req_recent = 0
             self._error_recent = 0
         if msg_type == 'http_curl_metrics':
             self._resp_time_recent.append(message['total_time'])
+            if 'corrected_total_time' in message:
+                self._corrected_resp_time_recent.append(message['corrected_total_time'])
             self._req_total += 1
             self._req_recent += 1
         elif msg_type in ('error', 'exception'):
@@ -1,36 +1,98 @@
 import nanomsg
 
-from .utils import pack_msg, unpack_msg
+from .utils import pack_msg, unpack_msg, check_compression_codec, compress_frame, StreamDecoder
+from .compact import CompactEncoder
+from collections import defaultdict
 import asyncio
 import logging
+import queue
+import threading
 
 logger = logging.getLogger(__name__)
 
 
+class _DuplicatorOutput:
+    def __init__(self, address, max_queue):
+        self.address = address
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._socket = nanomsg.Socket(nanomsg.PUSH)
+        self._socket.bind(address)
+        self._thread = threading.Thread(target=self._run, name='mite.duplicator %s' % (address,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            msg = self._queue.get()
+            if msg is None:
+                break
+            self._socket.send(msg)
+
+
 class Duplicator:
-    def __init__(self, in_address, out_addresses):
+    def __init__(self, in_address, out_addresses, max_queue=10000, loop=None):
         self._in_socket = nanomsg.Socket(nanomsg.PULL)
         self._in_socket.bind(in_address)
-        self._out_sockets = [nanomsg.Socket(nanomsg.PUSH) for i in out_addresses]
-        for socket, address in zip(self._out_sockets, out_addresses):
-            socket.bind(address)
+        self._outputs = [_DuplicatorOutput(address, max_queue) for address in out_addresses]
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
 
+    def output_stats(self):
+        return [(output.address, output.depth(), output.dropped) for output in self._outputs]
+
     async def run(self, stop_func=None):
         return await self._loop.run_in_executor(None, self._run, stop_func)
 
     def _run(self, stop_func=None):
-        while stop_func is None or not stop_func():
-            msg = self._in_socket.recv()
-            for socket in self._out_sockets:
-                socket.send(msg)
+        try:
+            while stop_func is None or not stop_func():
+                msg = self._in_socket.recv()
+                for output in self._outputs:
+                    output.put(msg)
+        finally:
+            for output in self._outputs:
+                output.close()
 
 
 class Sender:
-    def __init__(self):
+    def __init__(self, batch_size=1, batch_delay=0, compact=False, compression=None, hwm=None, overflow='block',
+                 loop=None):
+        # nanomsg bounds its send buffer in bytes (SNDBUF) rather than messages, so hwm has no equivalent here
+        if overflow != 'block':
+            raise ValueError('The nanomsg backend only supports the block overflow policy')
         self._socket = nanomsg.Socket(nanomsg.PUSH)
+        self.dropped = defaultdict(int)
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._batch = []
+        if compact:
+            self._encoder = CompactEncoder()
+            self._frame_start = pack_msg(self._encoder.frame_start())
+        else:
+            self._encoder = None
+            self._frame_start = b''
+        if compression is not None:
+            self._compression = check_compression_codec(compression)
+        else:
+            self._compression = None
+        self._flush_handle = None
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
 
     def bind(self, address):
         self._socket.bind(address)
@@ -38,8 +100,34 @@ class Sender:
     def connect(self, address):
         self._socket.connect(address)
 
+    def _pack(self, msg):
+        if self._encoder is None:
+            return pack_msg(msg)
+        return b''.join([pack_msg(record) for record in self._encoder.encode(msg)])
+
+    def _send_frame(self, frame):
+        if self._compression is not None:
+            frame = compress_frame(frame, self._compression)
+        self._socket.send(frame)
+
     def send(self, msg):
-        self._socket.send(pack_msg(msg))
+        if self._batch_size <= 1:
+            self._send_frame(self._frame_start + self._pack(msg))
+            return
+        self._batch.append(self._pack(msg))
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(self._batch_delay, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._batch:
+            # msgpack is self delimiting so a batch is just the packed messages back to back
+            self._send_frame(self._frame_start + b''.join(self._batch))
+            del self._batch[:]
 
 
 class Receiver:
@@ -51,6 +139,7 @@ class Receiver:
         if raw_listeners is None:
             raw_listeners = []
         self._raw_listeners = raw_listeners
+        self._decoder = StreamDecoder()
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
@@ -78,38 +167,43 @@ class Receiver:
             raw = self._recv()
             for raw_listener in self._raw_listeners:
                 raw_listener(raw)
-            msg = unpack_msg(raw)
-            for listener in self._listeners:
-                listener(msg)
+            if not self._listeners:
+                continue
+            for msg in self._decoder.decode_frame(raw):
+                for listener in self._listeners:
+                    listener(msg)
 
 
 _MSG_TYPE_HELLO = 1
 _MSG_TYPE_REQUEST_WORK = 2
 _MSG_TYPE_BYE = 3
+_MSG_TYPE_LEASE_DATA = 6
 
 
 class RunnerTransport:
-    def __init__(self, socket_address, loop=None):
+    def __init__(self, socket_address, timeout=5, retries=3, loop=None):
         self._sock = nanomsg.Socket(nanomsg.REQ)
+        # nanomsg REQ sockets resend unanswered requests themselves, retries has no equivalent
+        self._sock.set_int_option(nanomsg.REQ, nanomsg.REQ_RESEND_IVL, int(timeout * 1000))
         self._sock.connect(socket_address)
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
 
-    def _hello(self):
-        self._sock.send(pack_msg((_MSG_TYPE_HELLO, None)))
+    def _hello(self, weight):
+        self._sock.send(pack_msg((_MSG_TYPE_HELLO, weight)))
         return unpack_msg(self._sock.recv())
 
-    async def hello(self):
-        return await self._loop.run_in_executor(None, self._hello)
+    async def hello(self, weight=None):
+        return await self._loop.run_in_executor(None, self._hello, weight)
 
-    def _request_work(self, runner_id, current_work, completed_data_ids, max_work):
-        self._sock.send(pack_msg((_MSG_TYPE_REQUEST_WORK, [runner_id, current_work, completed_data_ids, max_work])))
+    def _request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats):
+        self._sock.send(pack_msg((_MSG_TYPE_REQUEST_WORK, [runner_id, current_work, completed_data_ids, max_work, runner_stats])))
         result = unpack_msg(self._sock.recv())
         return result
 
-    async def request_work(self, runner_id, current_work, completed_data_ids, max_work):
-        return await self._loop.run_in_executor(None, self._request_work, runner_id, current_work, completed_data_ids, max_work)
+    async def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        return await self._loop.run_in_executor(None, self._request_work, runner_id, current_work, completed_data_ids, max_work, runner_stats)
 
     def _bye(self, runner_id):
         self._sock.send(pack_msg((_MSG_TYPE_BYE, runner_id)))
@@ -118,6 +212,16 @@ class RunnerTransport:
     async def bye(self, runner_id):
         return await self._loop.run_in_executor(None, self._request_work, runner_id)
 
+    def _lease_data(self, runner_id, scenario_id, returned, lease):
+        self._sock.send(pack_msg((_MSG_TYPE_LEASE_DATA, [runner_id, scenario_id, returned, lease])))
+        return unpack_msg(self._sock.recv())
+
+    async def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        return await self._loop.run_in_executor(None, self._lease_data, runner_id, scenario_id, returned, lease)
+
+    async def subscribe(self, runner_id, max_work):
+        raise ValueError('nanomsg REQ sockets cannot have work pushed to them, use the ZMQ backend to subscribe')
+
 
 class ControllerServer:
     def __init__(self, socket_address, loop=None):
@@ -134,9 +238,11 @@ class ControllerServer:
         while stop_func is None or not stop_func():
             _type, content = unpack_msg(self._sock.recv())
             if _type == _MSG_TYPE_HELLO:
-                self._sock.send(pack_msg(controller.hello()))
+                self._sock.send(pack_msg(controller.hello(content)))
             elif _type == _MSG_TYPE_REQUEST_WORK:
                 self._sock.send(pack_msg(controller.request_work(*content)))
+            elif _type == _MSG_TYPE_LEASE_DATA:
+                self._sock.send(pack_msg(controller.lease_data(*content)))
             elif _type == _MSG_TYPE_BYE:
                 self._sock.send(pack_msg(controller.bye(content)))
 
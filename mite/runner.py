@@ -4,29 +4,36 @@ import time
 import logging
 
 from .context import Context
+from .datapools import ShardedDataPoolProxy
 from .utils import spec_import
 
 logger = logging.getLogger(__name__)
 
 
 class RunnerControllerTransportExample:
-    async def hello(self):
-        """Returns:
+    async def hello(self, weight=None):
+        """\
+        Takes:
+            weight - the runner's share of the volume relative to other runners, None for the default
+        Returns:
             runner_id
             test_name
             config_list - k, v pairs
+            partitioned_scenario_ids - scenarios whose work comes without data, the runner leases shards of it
             """
         pass
 
-    async def request_work(self, runner_id, current_work, completed_data_ids, max_work):
+    async def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
         """\
         Takes:
             runner_id
             current_work - dict of scenario_id, current volume
             completed_data_ids - list of scenario_id, scenario_data_id pairs
             max_work - may be None to indicate no limit
+            runner_stats - optional dict of extra runner state, e.g. worker_work - dict of worker runner_id, load
         Returns:
-            work - list of (scenario_id, scenario_data_id, journey_spec, args) - args and scenario_data_id may be None together
+            work - list of (scenario_id, scenario_data_id, journey_spec, args, start_delay) - args and scenario_data_id may be None together
+                start_delay is None to start straight away, otherwise seconds from now the journey is due to start
             config_list - k, v pairs
             stop
         """
@@ -39,6 +46,46 @@ class RunnerControllerTransportExample:
         """
         pass
 
+    async def subscribe(self, runner_id, max_work):
+        """\
+        Asks the controller to push work to this runner rather than have it polled for
+        Takes:
+            runner_id
+            max_work - may be None to indicate no limit
+        """
+        pass
+
+    async def report_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        """\
+        Used instead of request_work by a subscribed runner, takes the same arguments
+        Returns:
+            stop
+        """
+        pass
+
+    async def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        """\
+        Takes:
+            runner_id
+            scenario_id - a partitioned scenario
+            returned - list of shard_id, remaining_ids pairs for shards handed back, remaining_ids are those not used
+            lease - False to only hand shards back
+        Returns:
+            shard_id, list of (scenario_data_id, data) pairs, recycle - or None if there is no shard free
+                without recycle each item is used once and a shard is handed back when it's used up
+        """
+        pass
+
+    async def next_push(self):
+        """\
+        Waits for the controller to push to a subscribed runner
+        Returns:
+            work - as returned by request_work
+            config_list - k, v pairs
+            stop
+        """
+        pass
+
 
 class RunnerConfig:
     def __init__(self):
@@ -73,11 +120,13 @@ class RunnerConfig:
 
 class Runner:
     def __init__(self, transport, msg_sender, loop_wait_min=0.01, loop_wait_max=0.5, max_work=None, loop=None,
-                 debug=False):
+                 debug=False, subscribe=False, virtual_users=False, late_start_threshold=0.01, health_sampler=None,
+                 health_period=5, capacity_controller=None, weight=None):
         self._transport = transport
         self._msg_sender = msg_sender
         self._work = {}
         self._datapool_proxies = {}
+        self._datapool_waiting = {}
         self._stop = False
         self._loop_wait_min = loop_wait_min
         self._loop_wait_max = loop_wait_max
@@ -86,6 +135,18 @@ class Runner:
             loop = asyncio.get_event_loop()
         self._loop = loop
         self._debug = debug
+        self._subscribe = subscribe
+        self._virtual_users = virtual_users
+        self._late_start_threshold = late_start_threshold
+        self._health_sampler = health_sampler
+        self._health_period = health_period
+        self._health_handle = None
+        self._capacity_controller = capacity_controller
+        self._weight = weight
+        self._journeys = {}
+        self._vu_queues = {}
+        self._vu_idle = {}
+        self._vu_tasks = []
 
     def _inc_work(self, id):
         if id in self._work:
@@ -104,6 +165,94 @@ class Runner:
     def should_stop(self):
         return self._stop
 
+    def _get_max_work(self):
+        if self._capacity_controller is None:
+            return self._max_work
+        return self._capacity_controller.capacity(sum(self._work.values()))
+
+    def _runner_stats(self):
+        if self._health_sampler is None:
+            return None
+        return {'loop_lag': self._health_sampler.recent_lag()}
+
+    def _send_health(self, test_name, runner_id):
+        msg = self._health_sampler.sample()
+        msg.update({
+            'type': 'runner_health',
+            'time': time.time(),
+            'test': test_name,
+            'runner_id': runner_id,
+            'in_flight': sum(self._work.values())
+        })
+        if self._capacity_controller is not None:
+            msg['capacity'] = self._get_max_work()
+        self._msg_sender(msg)
+        self._health_handle = self._loop.call_later(self._health_period, self._send_health, test_name, runner_id)
+
+    def _start_health(self, test_name, runner_id):
+        if self._health_sampler is not None:
+            self._health_sampler.start()
+            self._health_handle = self._loop.call_later(self._health_period, self._send_health, test_name, runner_id)
+
+    def _stop_health(self):
+        if self._health_handle is not None:
+            self._health_handle.cancel()
+            self._health_handle = None
+            self._health_sampler.stop()
+
+    def _completed_data(self, scenario_id, scenario_data_id, completed_data_ids):
+        if scenario_data_id is None:
+            return
+        proxy = self._datapool_proxies.get(scenario_id)
+        if proxy is None:
+            completed_data_ids.append((scenario_id, scenario_data_id))
+        else:
+            proxy.checkin(scenario_data_id)
+
+    def _checkout_leased(self, runner_id, scenario_id, start, start_args):
+        """Returns an item from the scenario's shards or None, having queued start(*start_args, dpi) for a new shard"""
+        proxy = self._datapool_proxies.get(scenario_id)
+        if proxy is None:
+            proxy = self._datapool_proxies[scenario_id] = ShardedDataPoolProxy()
+        if scenario_id not in self._datapool_waiting:
+            dpi = proxy.checkout()
+            if dpi is not None:
+                return dpi
+            self._datapool_waiting[scenario_id] = []
+            asyncio.ensure_future(self._lease_data(runner_id, scenario_id, proxy, start))
+        self._datapool_waiting[scenario_id].append(start_args)
+        return None
+
+    async def _lease_data(self, runner_id, scenario_id, proxy, start):
+        waiting = self._datapool_waiting[scenario_id]
+        try:
+            while waiting:
+                shard = await self._transport.lease_data(runner_id, scenario_id, proxy.pop_returned())
+                if shard is None:
+                    logger.debug('No data shard free for scenario %d, dropping %d journeys', scenario_id, len(waiting))
+                    break
+                proxy.add_shard(*shard)
+                while waiting:
+                    dpi = proxy.checkout()
+                    if dpi is None:
+                        break
+                    start(*waiting.pop(0), dpi)
+        finally:
+            for _ in waiting:
+                self._dec_work(scenario_id)
+            del self._datapool_waiting[scenario_id]
+
+    async def _return_data(self, runner_id, release_all=False):
+        for scenario_id, proxy in list(self._datapool_proxies.items()):
+            if scenario_id in self._datapool_waiting:
+                # The lease request will take them
+                continue
+            if release_all:
+                proxy.release_all()
+            returned = proxy.pop_returned()
+            if returned:
+                await self._transport.lease_data(runner_id, scenario_id, returned, False)
+
     async def complete_running(self, fs, min_time, max_time):
         if not fs:
             await asyncio.sleep(max_time)
@@ -137,8 +286,7 @@ class Runner:
             if f.done():
                 scenario_id, scenario_data_id = f.result()
                 self._dec_work(scenario_id)
-                if scenario_data_id is not None:
-                    completed_data_ids.append((scenario_id, scenario_data_id))
+                self._completed_data(scenario_id, scenario_data_id, completed_data_ids)
             else:
                 still_running.append(f)
         return still_running, completed_data_ids
@@ -146,10 +294,14 @@ class Runner:
     async def run(self):
         context_id_gen = count(1)
         config = RunnerConfig()
-        runner_id, test_name, config_list = await self._transport.hello()
+        runner_id, test_name, config_list, partitioned_scenario_ids = await self._transport.hello(self._weight)
+        partitioned_scenario_ids = set(partitioned_scenario_ids)
         config._update(config_list)
+        self._start_health(test_name, runner_id)
         logger.debug("Entering run loop")
         _completed = []
+        _finished = []
+        batch_handle = None
 
         def on_completion(f):
             nonlocal waiter, _completed
@@ -157,59 +309,195 @@ class Runner:
             if not waiter.done():
                 waiter.set_result(None)
 
+        def on_finished(scenario_id, scenario_data_id):
+            # Virtual users finish far more often than tasks, wake once per batch rather than per journey
+            nonlocal batch_handle
+            _finished.append((scenario_id, scenario_data_id))
+            if batch_handle is None:
+                batch_handle = self._loop.call_later(self._loop_wait_min, stop_waiting)
+
         def stop_waiting():
             nonlocal waiter
             if not waiter.done():
                 waiter.set_result(None)
 
         async def wait():
-            nonlocal waiter, timeout_handle, _completed
+            nonlocal waiter, timeout_handle, _completed, batch_handle
             await waiter
             timeout_handle.cancel()
             timeout_handle = self._loop.call_later(self._loop_wait_max, stop_waiting)
+            if batch_handle is not None:
+                batch_handle.cancel()
+                batch_handle = None
             waiter = self._loop.create_future()
             c = []
             for f in _completed:
                 scenario_id, scenario_data_id = f.result()
                 self._dec_work(scenario_id)
-                if scenario_data_id is not None:
-                    c.append((scenario_id, scenario_data_id))
+                self._completed_data(scenario_id, scenario_data_id, c)
             del _completed[:]
+            for scenario_id, scenario_data_id in _finished:
+                self._dec_work(scenario_id)
+                self._completed_data(scenario_id, scenario_data_id, c)
+            del _finished[:]
+            await self._return_data(runner_id)
             return c
 
+        def start_leased(scenario_id, scenario_data_id, journey_spec, args, start_at, dpi):
+            start_one(scenario_id, dpi.id, journey_spec, dpi.data, start_at)
+
+        def start_one(scenario_id, scenario_data_id, journey_spec, args, start_at):
+            if scenario_data_id is None and scenario_id in partitioned_scenario_ids:
+                dpi = self._checkout_leased(runner_id, scenario_id, start_leased,
+                                            (scenario_id, scenario_data_id, journey_spec, args, start_at))
+                if dpi is None:
+                    return
+                scenario_data_id, args = dpi.id, dpi.data
+            if self._virtual_users:
+                self._queue_virtual_user_work(scenario_id, scenario_data_id, journey_spec, args, start_at, test_name,
+                                              runner_id, config, context_id_gen, on_finished)
+                return
+            id_data = {
+                'test': test_name,
+                'runner_id': runner_id,
+                'journey': journey_spec,
+                'context_id': next(context_id_gen),
+                'scenario_id': scenario_id,
+                'scenario_data_id': scenario_data_id
+            }
+            context = Context(self._msg_sender, config, id_data=id_data, should_stop_func=self.should_stop,
+                              debug=self._debug)
+            future = asyncio.ensure_future(
+                self._execute(context, scenario_id, scenario_data_id, journey_spec, args, start_at))
+            future.add_done_callback(on_completion)
+
+        def start_work(work):
+            for scenario_id, scenario_data_id, journey_spec, args, start_delay in work:
+                self._inc_work(scenario_id)
+                if start_delay is None:
+                    start_one(scenario_id, scenario_data_id, journey_spec, args, None)
+                    continue
+                start_at = self._loop.time() + start_delay
+                if start_delay > 0:
+                    self._loop.call_at(start_at, start_one, scenario_id, scenario_data_id, journey_spec, args, start_at)
+                else:
+                    start_one(scenario_id, scenario_data_id, journey_spec, args, start_at)
+
+        async def receive_pushes():
+            # Work is started the moment it arrives, the run loop below only reports back
+            while not self._stop:
+                work, config_list, stop = await self._transport.next_push()
+                config._update(config_list)
+                start_work(work)
+                if stop:
+                    self._stop = True
+                    stop_waiting()
+
         timeout_handle = self._loop.call_later(self._loop_wait_max, stop_waiting)
         waiter = self._loop.create_future()
         completed_data_ids = []
+        if self._subscribe:
+            await self._transport.subscribe(runner_id, self._get_max_work())
+            push_task = asyncio.ensure_future(receive_pushes())
+            while not self._stop:
+                stop = await self._transport.report_work(runner_id, self._current_work(), completed_data_ids,
+                                                         self._get_max_work(), self._runner_stats())
+                self._stop = self._stop or stop
+                completed_data_ids = await wait()
+            push_task.cancel()
+            while self._current_work():
+                await self._transport.report_work(runner_id, self._current_work(), completed_data_ids, 0)
+                completed_data_ids = await wait()
+            await self._transport.report_work(runner_id, self._current_work(), completed_data_ids, 0)
+            await self._return_data(runner_id, release_all=True)
+            await self._transport.bye(runner_id)
+            self._stop_virtual_users()
+            self._stop_health()
+            return
         while not self._stop:
             work, config_list, self._stop = await self._transport.request_work(runner_id, self._current_work(),
-                                                                               completed_data_ids, self._max_work)
+                                                                               completed_data_ids, self._get_max_work(),
+                                                                               self._runner_stats())
             config._update(config_list)
-            for num, (scenario_id, scenario_data_id, journey_spec, args) in enumerate(work):
-                id_data = {
-                    'test': test_name,
-                    'runner_id': runner_id,
-                    'journey': journey_spec,
-                    'context_id': next(context_id_gen),
-                    'scenario_id': scenario_id,
-                    'scenario_data_id': scenario_data_id
-                }
-                context = Context(self._msg_sender, config, id_data=id_data, should_stop_func=self.should_stop,
-                                  debug=self._debug)
-                self._inc_work(scenario_id)
-                future = asyncio.ensure_future(
-                    self._execute(context, scenario_id, scenario_data_id, journey_spec, args))
-                future.add_done_callback(on_completion)
+            start_work(work)
             completed_data_ids = await wait()
         while self._current_work():
             _, config_list, _ = await self._transport.request_work(runner_id, self._current_work(), completed_data_ids,0)
             config._update(config_list)
             completed_data_ids = await wait()
         await self._transport.request_work(runner_id, self._current_work(), completed_data_ids, 0)
+        await self._return_data(runner_id, release_all=True)
         await self._transport.bye(runner_id)
+        self._stop_virtual_users()
+        self._stop_health()
+
+    def _get_journey(self, journey_spec):
+        journey = self._journeys.get(journey_spec)
+        if journey is None:
+            journey = self._journeys[journey_spec] = spec_import(journey_spec)
+        return journey
+
+    def _check_start_lag(self, context, start_at):
+        lag = max(0, self._loop.time() - start_at)
+        context._start_lag = lag
+        if lag > self._late_start_threshold:
+            context.send('late_start', lag=lag)
+
+    def _queue_virtual_user_work(self, scenario_id, scenario_data_id, journey_spec, args, start_at, test_name,
+                                 runner_id, config, context_id_gen, on_finished):
+        queue = self._vu_queues.get(scenario_id)
+        if queue is None:
+            queue = self._vu_queues[scenario_id] = asyncio.Queue()
+            self._vu_idle[scenario_id] = 0
+        if start_at is None:
+            # Time spent waiting for a free virtual user counts as lag too
+            start_at = self._loop.time()
+        queue.put_nowait((scenario_data_id, journey_spec, args, start_at))
+        if queue.qsize() > self._vu_idle[scenario_id]:
+            id_data = {
+                'test': test_name,
+                'runner_id': runner_id,
+                'journey': journey_spec,
+                'context_id': None,
+                'scenario_id': scenario_id,
+                'scenario_data_id': scenario_data_id
+            }
+            context = Context(self._msg_sender, config, id_data=id_data, should_stop_func=self.should_stop,
+                              debug=self._debug)
+            self._vu_tasks.append(asyncio.ensure_future(
+                self._virtual_user(context, id_data, scenario_id, queue, context_id_gen, on_finished)))
+
+    async def _virtual_user(self, context, id_data, scenario_id, queue, context_id_gen, on_finished):
+        # One long lived coroutine and context running journey after journey of a scenario, only the ids change
+        while True:
+            self._vu_idle[scenario_id] += 1
+            try:
+                scenario_data_id, journey_spec, args, start_at = await queue.get()
+            finally:
+                self._vu_idle[scenario_id] -= 1
+            id_data['journey'] = journey_spec
+            id_data['context_id'] = next(context_id_gen)
+            id_data['scenario_data_id'] = scenario_data_id
+            self._check_start_lag(context, start_at)
+            async with context._exception_handler():
+                async with context.transaction('__root__'):
+                    journey = self._get_journey(journey_spec)
+                    if args is None:
+                        await journey(context)
+                    else:
+                        await journey(context, *args)
+            on_finished(scenario_id, scenario_data_id)
+
+    def _stop_virtual_users(self):
+        for task in self._vu_tasks:
+            task.cancel()
+        del self._vu_tasks[:]
 
-    async def _execute(self, context, scenario_id, scenario_data_id, journey_spec, args):
+    async def _execute(self, context, scenario_id, scenario_data_id, journey_spec, args, start_at=None):
         logger.debug('Runner._execute starting scenario_id=%r scenario_data_id=%r journey_spec=%r args=%r', scenario_id,
                      scenario_data_id, journey_spec, args)
+        if start_at is not None:
+            self._check_start_lag(context, start_at)
         async with context._exception_handler():
             async with context.transaction('__root__'):
                 journey = spec_import(journey_spec)
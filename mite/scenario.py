@@ -1,10 +1,11 @@
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from itertools import count
+import math
 import time
 import logging
 import random
 
-from .datapools import DataPoolExhausted
+from .datapools import DataPoolExhausted, PartitionedDataPool
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +17,35 @@ class StopScenario(Exception):
     pass
 
 
+class ArrivalRate:
+    """Marks a volume model as giving journeys to start per second rather than journeys to keep running
+
+    Arrivals are spread over the period either evenly or as a poisson process. Once a journey is due it
+    starts however many are already running, up to max_in_flight for the whole test, beyond which arrivals
+    are skipped and counted.
+    """
+    DISTRIBUTIONS = ('poisson', 'constant')
+
+    def __init__(self, volumemodel, distribution='poisson', max_in_flight=10000):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError('Unknown arrival distribution %r, expected one of %r' % (distribution, self.DISTRIBUTIONS))
+        self.volumemodel = volumemodel
+        self.distribution = distribution
+        self.max_in_flight = max_in_flight
+
+    def __call__(self, start, end):
+        return self.volumemodel(start, end)
+
+    def __repr__(self):
+        return 'ArrivalRate(%r, distribution=%r, max_in_flight=%r)' % (self.volumemodel, self.distribution,
+                                                                     self.max_in_flight)
+
+    def interval(self, rate):
+        if self.distribution == 'poisson':
+            return random.expovariate(rate)
+        return 1 / rate
+
+
 def _volume_dicts_remove_a_from_b(a, b):
     diff = dict(b)
     for scenario_id, current_num in a.items():
@@ -26,6 +56,53 @@ def _volume_dicts_remove_a_from_b(a, b):
     return diff
 
 
+class _DeficitSampler:
+    """Draws scenario ids in proportion to their deficits, taking one off the drawn id's deficit each time
+
+    Drawing like this gives the same order as shuffling a list with each id repeated deficit times, without
+    building the list. Deficits live in a Fenwick tree so a draw is O(log scenarios).
+    """
+    def __init__(self, deficits):
+        self._ids = list(deficits)
+        self._index = {scenario_id: i for i, scenario_id in enumerate(self._ids)}
+        self._deficits = [deficits[scenario_id] for scenario_id in self._ids]
+        self._total = sum(self._deficits)
+        n = len(self._ids)
+        self._tree = [0] + self._deficits
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self._tree[parent] += self._tree[i]
+        self._top_bit = 1 << (n.bit_length() - 1) if n else 0
+
+    def __len__(self):
+        return self._total
+
+    def _add(self, i, amount):
+        self._deficits[i] += amount
+        self._total += amount
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += amount
+            i += i & -i
+
+    def draw(self):
+        r = random.randrange(self._total)
+        pos = 0
+        bit = self._top_bit
+        while bit:
+            if pos + bit < len(self._tree) and self._tree[pos + bit] <= r:
+                pos += bit
+                r -= self._tree[pos]
+            bit >>= 1
+        self._add(pos, -1)
+        return self._ids[pos]
+
+    def remove(self, scenario_id):
+        i = self._index[scenario_id]
+        self._add(i, -self._deficits[i])
+
+
 class ScenarioManager:
     def __init__(self, start_delay=0, period=1, spawn_rate=None):
         self._period = period
@@ -36,6 +113,9 @@ class ScenarioManager:
         self._current_period_end = 0
         self._spawn_rate = spawn_rate
         self._required = {}
+        self._rates = {}
+        self._next_arrival = {}
+        self._skipped_arrivals = defaultdict(int)
         self._scenarios = {}
 
     def _now(self):
@@ -48,16 +128,94 @@ class ScenarioManager:
 
     def _update_required_and_period(self, start_of_period, end_of_period):
         required = {}
+        rates = {}
         for scenario_id, scenario in list(self._scenarios.items()):
             try:
-                number = int(scenario.volumemodel(start_of_period, end_of_period))
+                if isinstance(scenario.volumemodel, ArrivalRate):
+                    rates[scenario_id] = float(scenario.volumemodel(start_of_period, end_of_period))
+                else:
+                    required[scenario_id] = int(scenario.volumemodel(start_of_period, end_of_period))
             except StopScenario:
                 logger.info('Removed scenario %d because volume model raised StopScenario', scenario_id)
                 del self._scenarios[scenario_id]
-            else:
-                required[scenario_id] = number
         self._current_period_end = end_of_period
         self._required = required
+        self._rates = rates
+
+    def get_arrival_rates(self):
+        return self._rates
+
+    def pop_skipped_arrivals(self):
+        skipped = dict(self._skipped_arrivals)
+        self._skipped_arrivals.clear()
+        return skipped
+
+    def _checkout_many(self, scenario_id, scenario, n):
+        """Returns up to n work items without their start delays, fewer if there isn't the data for them right now"""
+        if scenario.datapool is None:
+            return [(scenario_id, None, scenario.journey_spec, None)] * n
+        try:
+            if isinstance(scenario.datapool, PartitionedDataPool):
+                if scenario.datapool.exhausted:
+                    raise DataPoolExhausted()
+                # The runner checks the data out of a shard it has leased
+                return [(scenario_id, None, scenario.journey_spec, None)] * n
+            if hasattr(scenario.datapool, 'checkout_many'):
+                dpis = scenario.datapool.checkout_many(n)
+            else:
+                dpis = []
+                for _ in range(n):
+                    dpi = scenario.datapool.checkout()
+                    if dpi is None:
+                        break
+                    dpis.append(dpi)
+        except DataPoolExhausted:
+            logger.info('Removed scenario %d because data pool exhausted', scenario_id)
+            del self._scenarios[scenario_id]
+            return []
+        return [(scenario_id, dpi.id, scenario.journey_spec, dpi.data) for dpi in dpis]
+
+    def _checkout(self, scenario_id, scenario):
+        """Returns a work item without its start delay or None if there is no data for one right now"""
+        items = self._checkout_many(scenario_id, scenario, 1)
+        return items[0] if items else None
+
+    def _get_arrivals(self, current_work, runner_fraction, limit, work, scenario_volume_map):
+        # Each request takes at most its share of the next period's arrivals so they spread over the
+        # runners however their requests line up
+        now = time.time()
+        until = now + self._period
+        for scenario_id, rate in self._rates.items():
+            if limit <= 0:
+                break
+            if rate <= 0 or scenario_id not in self._scenarios:
+                self._next_arrival.pop(scenario_id, None)
+                continue
+            scenario = self._scenarios[scenario_id]
+            next_arrival = self._next_arrival.get(scenario_id)
+            if next_arrival is None or next_arrival < now - self._period:
+                # Starting, or nobody has asked for work for a while, there's no catching up on that
+                next_arrival = now
+            share = min(limit, math.ceil(rate * self._period * runner_fraction))
+            in_flight = current_work.get(scenario_id, 0)
+            taken = 0
+            while next_arrival < until and taken < share:
+                if in_flight + taken >= scenario.volumemodel.max_in_flight:
+                    self._skipped_arrivals[scenario_id] += 1
+                else:
+                    item = self._checkout(scenario_id, scenario)
+                    if item is None:
+                        if scenario_id not in self._scenarios:
+                            break
+                        self._skipped_arrivals[scenario_id] += 1
+                    else:
+                        work.append(item + (next_arrival - now,))
+                        taken += 1
+                next_arrival += scenario.volumemodel.interval(rate)
+            self._next_arrival[scenario_id] = next_arrival
+            limit -= taken
+            if taken:
+                scenario_volume_map[scenario_id] = scenario_volume_map.get(scenario_id, 0) + taken
 
     def get_required_work(self):
         if self._in_start:
@@ -71,14 +229,18 @@ class ScenarioManager:
             self._update_required_and_period(self._current_period_end, int(now + self._period))
         return self._required
 
-    def get_work(self, current_work, num_runner_current_work , num_runners, runner_self_limit, hit_rate):
+    def get_work(self, current_work, num_runner_current_work , num_runners, runner_self_limit, hit_rate,
+                 runner_fraction=None):
+        """runner_fraction is the runner's part of the total capacity, by default an even split"""
+        if runner_fraction is None:
+            runner_fraction = 1 / num_runners
         required = self.get_required_work()
         diff = _volume_dicts_remove_a_from_b(current_work, required)
         total = sum(required.values())
-        runners_share_limit = total / num_runners - num_runner_current_work 
+        runners_share_limit = total * runner_fraction - num_runner_current_work
         limit = max(0, runners_share_limit)
         if runner_self_limit is not None:
-            limit = min(limit, runners_share_limit)
+            limit = max(0, min(limit, runner_self_limit - num_runner_current_work))
         spawn_limit = None
         if self._spawn_rate is not None and hit_rate > 1:
             spawn_limit = self._spawn_rate / hit_rate
@@ -87,36 +249,31 @@ class ScenarioManager:
             if limit % 1 > random.random():
                 limit += 1
         limit = int(limit)
-        def _yield(diff):
-            for k, v in diff.items():
-                for i in range(v):
-                    yield k
-        scenario_ids = list(_yield(diff))
-        random.shuffle(scenario_ids)
         work = []
         scenario_volume_map = {}
-        for scenario_id in scenario_ids:
-            if len(work) >= limit:
-                break
-            if scenario_id in self._scenarios:
-                scenario = self._scenarios[scenario_id]
-                if scenario.datapool is None:
-                    work.append((scenario_id, None, scenario.journey_spec, None))
-                else:
-                    try:
-                        dpi = scenario.datapool.checkout()
-                    except DataPoolExhausted:
-                        logger.info('Removed scenario %d because data pool exhausted', scenario_id)
-                        del self._scenarios[scenario_id]
-                        continue
-                    else:
-                        if dpi is None:
-                            continue
-                        work.append((scenario_id, dpi.id, scenario.journey_spec, dpi.data))
-                if scenario_id in scenario_volume_map:
-                    scenario_volume_map[scenario_id] += 1
-                else:
-                    scenario_volume_map[scenario_id] = 1
+        # Only as many draws as work is handed out, however far volume is from being met. Each scenario's data
+        # is checked out in one go, one that comes up short is out of data for now so isn't drawn again
+        sampler = _DeficitSampler(diff)
+        while len(work) < limit and sampler:
+            wanted = defaultdict(int)
+            for _ in range(min(limit - len(work), len(sampler))):
+                wanted[sampler.draw()] += 1
+            for scenario_id, n in wanted.items():
+                items = []
+                if scenario_id in self._scenarios:
+                    items = self._checkout_many(scenario_id, self._scenarios[scenario_id], n)
+                if len(items) < n:
+                    sampler.remove(scenario_id)
+                if items:
+                    work.extend(item + (None,) for item in items)
+                    scenario_volume_map[scenario_id] = scenario_volume_map.get(scenario_id, 0) + len(items)
+        if self._rates:
+            # Arrivals aren't held back by the runner's share of the volume or the spawn rate, only by the
+            # runner's own limit
+            arrivals_limit = float('inf')
+            if runner_self_limit is not None:
+                arrivals_limit = max(0, runner_self_limit - num_runner_current_work - len(work))
+            self._get_arrivals(current_work, runner_fraction, arrivals_limit, work, scenario_volume_map)
         logger.debug('current=%r required=%r diff=%r limit=%r runners_share_limit=%r spawn_limit=%r runner_self_limit=%r num_runners=%r spawn_rate=%r hit_rate=%r num_runner_current_work=%r len_work=%r', 
                      sum(current_work.values()), sum(required.values()), sum(diff.values()), limit, runners_share_limit, spawn_limit, runner_self_limit, num_runners, self._spawn_rate, hit_rate, num_runner_current_work, len(work))
         return work, scenario_volume_map
@@ -124,10 +281,33 @@ class ScenarioManager:
     def is_active(self):
         return self._in_start or bool(self._scenarios)
 
+    def get_partitioned_scenario_ids(self):
+        return [scenario_id for scenario_id, scenario in self._scenarios.items()
+                if isinstance(scenario.datapool, PartitionedDataPool)]
+
+    def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        scenario = self._scenarios.get(scenario_id)
+        if scenario is None or not isinstance(scenario.datapool, PartitionedDataPool):
+            return None
+        for shard_id, remaining_ids in returned:
+            scenario.datapool.release(runner_id, shard_id, remaining_ids)
+        if lease:
+            return scenario.datapool.lease(runner_id)
+        return None
+
+    def release_data(self, runner_id):
+        for scenario in self._scenarios.values():
+            if isinstance(scenario.datapool, PartitionedDataPool):
+                scenario.datapool.release_runner(runner_id)
+
     def checkin_data(self, ids):
+        """Returns the ids checked in, those of scenarios that have ended can't be"""
+        checked_in = set()
         for scenario_id, scenario_data_id in ids:
             if scenario_id in self._scenarios:
                 self._scenarios[scenario_id].datapool.checkin(scenario_data_id)
+                checked_in.add((scenario_id, scenario_data_id))
+        return checked_in
 
 
 
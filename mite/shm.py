@@ -0,0 +1,270 @@
+from collections import defaultdict
+import asyncio
+import atexit
+import logging
+import mmap
+import os
+import random
+import struct
+
+from .utils import pack_msg, check_compression_codec, compress_frame, StreamDecoder
+from .compact import CompactEncoder
+# Controller traffic is request/response between hosts, it stays on ZMQ
+from .zmq import RunnerTransport, ControllerServer, _MAX_DRAIN
+
+logger = logging.getLogger(__name__)
+
+# Each Sender owns one memory mapped ring file in the message directory, any number of Receivers read it
+# independently. The writer never waits for readers: a reader that falls a whole ring behind skips to the
+# newest data and counts what it missed.
+#
+# Header: magic, data capacity, claim position, write position. Positions are total bytes ever written,
+# claim is moved before a record is written and write after, so a reader can tell when the bytes it
+# just copied may have been overwritten. Records are a u32 length then the frame, padded to 8 bytes. A
+# length of _WRAP means the rest of the lap is unused.
+_MAGIC = b'MITERNG1'
+_header = struct.Struct('<8sQQQ')
+_HEADER_SIZE = 64
+_CLAIM_OFFSET = 16
+_WRITE_OFFSET = 24
+_u64 = struct.Struct('<Q')
+_u32 = struct.Struct('<I')
+_WRAP = 0xffffffff
+_RING_SUFFIX = '.ring'
+
+
+def _directory(address):
+    if address.startswith('shm://'):
+        address = address[len('shm://'):]
+    return address
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class Duplicator:
+    def __init__(self, in_address, out_addresses, max_queue=None, loop=None):
+        raise ValueError('The shm backend has no duplicator, every receiver reads the rings directly')
+
+
+class _RingWriter:
+    def __init__(self, path, capacity):
+        self.path = path
+        self._capacity = capacity
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+        try:
+            os.ftruncate(fd, _HEADER_SIZE + capacity)
+            self._mm = mmap.mmap(fd, _HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+        self._pos = 0
+        _header.pack_into(self._mm, 0, _MAGIC, capacity, 0, 0)
+
+    def write(self, frame):
+        size = _align(4 + len(frame))
+        if size > self._capacity:
+            raise ValueError('Frame of %d bytes does not fit in a ring of %d bytes' % (len(frame), self._capacity))
+        offset = self._pos % self._capacity
+        skip = 0
+        if offset + size > self._capacity:
+            skip = self._capacity - offset
+        _u64.pack_into(self._mm, _CLAIM_OFFSET, self._pos + skip + size)
+        if skip:
+            _u32.pack_into(self._mm, _HEADER_SIZE + offset, _WRAP)
+            offset = 0
+        start = _HEADER_SIZE + offset
+        _u32.pack_into(self._mm, start, len(frame))
+        self._mm[start + 4:start + 4 + len(frame)] = frame
+        self._pos += skip + size
+        _u64.pack_into(self._mm, _WRITE_OFFSET, self._pos)
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._mm.close()
+
+
+class _RingReader:
+    def __init__(self, path, from_start):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.capacity, _, write_pos = _header.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError('%s is not a mite ring' % (path,))
+        self._pos = 0 if from_start and write_pos <= self.capacity else write_pos
+        self.overruns = 0
+
+    def _overrun(self):
+        # We've been lapped, everything between here and the newest record is gone
+        self.overruns += 1
+        self._pos = _u64.unpack_from(self._mm, _WRITE_OFFSET)[0]
+
+    def read(self, limit):
+        frames = []
+        mm = self._mm
+        capacity = self.capacity
+        write_pos = _u64.unpack_from(mm, _WRITE_OFFSET)[0]
+        if write_pos - self._pos > capacity:
+            self._overrun()
+            return frames
+        while self._pos < write_pos and len(frames) < limit:
+            offset = self._pos % capacity
+            length = _u32.unpack_from(mm, _HEADER_SIZE + offset)[0]
+            if length == _WRAP:
+                self._pos += capacity - offset
+                continue
+            start = _HEADER_SIZE + offset + 4
+            frame = mm[start:start + length]
+            if _u64.unpack_from(mm, _CLAIM_OFFSET)[0] - self._pos > capacity:
+                self._overrun()
+                break
+            frames.append(frame)
+            self._pos += _align(4 + length)
+        return frames
+
+    def close(self):
+        self._mm.close()
+
+
+class Sender:
+    def __init__(self, batch_size=1, batch_delay=0, compact=False, compression=None, hwm=None, overflow=None,
+                 ring_size=64 * 1024 * 1024, loop=None):
+        # The ring never blocks a runner, lagging readers lose the oldest data instead, so hwm and overflow
+        # have no equivalent here. Losses are counted by the readers.
+        self._ring_size = ring_size
+        self._ring = None
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._batch = []
+        if compact:
+            self._encoder = CompactEncoder()
+            self._frame_start = pack_msg(self._encoder.frame_start())
+        else:
+            self._encoder = None
+            self._frame_start = b''
+        if compression is not None:
+            self._compression = check_compression_codec(compression)
+        else:
+            self._compression = None
+        self.dropped = defaultdict(int)
+        self._flush_handle = None
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+    def connect(self, address):
+        name = '%d-%08x%s' % (os.getpid(), random.getrandbits(32), _RING_SUFFIX)
+        self._ring = _RingWriter(os.path.join(_directory(address), name), self._ring_size)
+        atexit.register(self._ring.close)
+
+    bind = connect
+
+    def _pack(self, msg):
+        if self._encoder is None:
+            return pack_msg(msg)
+        return b''.join([pack_msg(record) for record in self._encoder.encode(msg)])
+
+    def _send_frame(self, frame):
+        if self._compression is not None:
+            frame = compress_frame(frame, self._compression)
+        self._ring.write(frame)
+
+    def send(self, msg):
+        if self._batch_size <= 1:
+            self._send_frame(self._frame_start + self._pack(msg))
+            return
+        self._batch.append(self._pack(msg))
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(self._batch_delay, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._batch:
+            self._send_frame(self._frame_start + b''.join(self._batch))
+            del self._batch[:]
+
+
+class Receiver:
+    def __init__(self, listeners=None, raw_listeners=None, poll_interval=0.001, scan_interval=1, loop=None):
+        self._directory = None
+        self._readers = {}
+        self._poll_interval = poll_interval
+        self._scan_interval = scan_interval
+        if listeners is None:
+            listeners = []
+        self._listeners = listeners
+        if raw_listeners is None:
+            raw_listeners = []
+        self._raw_listeners = raw_listeners
+        self._decoder = StreamDecoder()
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+    def connect(self, address):
+        self._directory = _directory(address)
+        os.makedirs(self._directory, exist_ok=True)
+        # Rings that already exist may be left over from earlier runs, only read what's written from now on
+        self._scan(from_start=False)
+
+    bind = connect
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def add_raw_listener(self, listener):
+        self._raw_listeners.append(listener)
+
+    def _scan(self, from_start=True):
+        paths = set(os.path.join(self._directory, fn) for fn in os.listdir(self._directory)
+                    if fn.endswith(_RING_SUFFIX))
+        for path in paths - set(self._readers):
+            try:
+                self._readers[path] = _RingReader(path, from_start)
+            except (OSError, ValueError):
+                logger.exception('Could not open ring %s', path)
+        for path in set(self._readers) - paths:
+            # The sender has gone, our mapping outlives the file so pick up whatever it wrote last
+            reader = self._readers.pop(path)
+            for frame in reader.read(reader.capacity):
+                self._process(frame)
+            self._log_overruns(reader)
+            reader.close()
+
+    def _log_overruns(self, reader):
+        if reader.overruns:
+            logger.warning('Fell a whole ring behind %s %d times and skipped ahead', reader.path, reader.overruns)
+            reader.overruns = 0
+
+    def _process(self, raw):
+        for raw_listener in self._raw_listeners:
+            raw_listener(raw)
+        if not self._listeners:
+            return
+        for msg in self._decoder.decode_frame(raw):
+            for listener in self._listeners:
+                listener(msg)
+
+    async def run(self, stop_func=None):
+        next_scan = self._loop.time() + self._scan_interval
+        while stop_func is None or not stop_func():
+            busy = False
+            for reader in list(self._readers.values()):
+                frames = reader.read(_MAX_DRAIN)
+                busy = busy or len(frames) == _MAX_DRAIN
+                for frame in frames:
+                    self._process(frame)
+            if self._loop.time() >= next_scan:
+                for reader in self._readers.values():
+                    self._log_overruns(reader)
+                self._scan()
+                next_scan = self._loop.time() + self._scan_interval
+            await asyncio.sleep(0 if busy else self._poll_interval)
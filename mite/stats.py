@@ -38,6 +38,24 @@ class Gauge:
         return {'type': 'Gauge', 'name': self._name, 'metrics': metrics, 'labels': self._labels_and_value_extractor.labels}
 
 
+class ValueCounter:
+    def __init__(self, name, matcher, labels_and_value_extractor):
+        self._name = name
+        self._matcher = matcher
+        self._labels_and_value_extractor = labels_and_value_extractor
+        self._metrics = defaultdict(int)
+
+    def process(self, msg):
+        if self._matcher(msg):
+            for key, value in self._labels_and_value_extractor(msg):
+                self._metrics[key] += value
+
+    def dump(self):
+        metrics = dict(self._metrics)
+        self._metrics.clear()
+        return {'type': 'Counter', 'name': self._name, 'metrics': metrics, 'labels': self._labels_and_value_extractor.labels}
+
+
 class Histogram:
     def __init__(self, name, matcher, labels_and_value_extractor, bins):
         self._name = name
@@ -87,8 +105,10 @@ def labels_extractor(labels):
     return extract_items
 
 
-def labels_and_value_extractor(labels, value_key):
+def labels_and_value_extractor(labels, value_key, optional=False):
     def extract_items(msg):
+        if optional and value_key not in msg:
+            return
         yield tuple(msg.get(i, '') for i in labels), msg[value_key]
     extract_items.labels = labels
     return extract_items
@@ -102,18 +122,49 @@ def controller_report_extractor(dict_key):
     return extract_items
 
 
+def dict_value_extractor(labels, dict_key, dict_key_label):
+    def extract_items(msg):
+        label_values = tuple(msg.get(i, '') for i in labels)
+        for key, value in msg[dict_key].items():
+            yield label_values + (key,), value
+    extract_items.labels = tuple(labels) + (dict_key_label,)
+    return extract_items
+
+
 class Stats:
     def __init__(self):
         transaction_key = 'test journey transaction'.split()
+        runner_key = ['test', 'runner_id']
+        latency_bins = [0.0001, 0.001, 0.01, 0.05, 0.1, 0.2, 0.4, 0.8, 1, 2, 4, 8, 16, 32, 64]
         self.processors = [
                 Counter('mite_journey_error_total', matcher_by_type('error', 'exception'), labels_extractor('test journey transaction location message'.split())),
                 Counter('mite_transaction_start_total',  matcher_by_type('start'), labels_extractor(transaction_key)),
                 Counter('mite_transaction_end_total',  matcher_by_type('end'), labels_extractor(transaction_key)),
                 Counter('mite_http_response_total', matcher_by_type('http_curl_metrics'), labels_extractor('test journey transaction method code'.split())),
-                Histogram('mite_http_response_time_seconds', matcher_by_type('http_curl_metrics'), labels_and_value_extractor(['transaction'], 'total_time'), [0.0001, 0.001, 0.01, 0.05, 0.1, 0.2, 0.4, 0.8, 1, 2, 4, 8, 16, 32, 64]),
+                Histogram('mite_http_response_time_seconds', matcher_by_type('http_curl_metrics'), labels_and_value_extractor(['transaction'], 'total_time'), latency_bins),
+                Histogram('mite_http_response_corrected_time_seconds', matcher_by_type('http_curl_metrics'), labels_and_value_extractor(['transaction'], 'corrected_total_time'), latency_bins),
+                Histogram('mite_transaction_duration_seconds', matcher_by_type('end'), labels_and_value_extractor(transaction_key, 'duration'), latency_bins),
+                Histogram('mite_transaction_corrected_duration_seconds', matcher_by_type('end'), labels_and_value_extractor(transaction_key, 'corrected_duration'), latency_bins),
                 Gauge('mite_actual_count', matcher_by_type('controller_report'), controller_report_extractor('actual')),
                 Gauge('mite_requird_count', matcher_by_type('controller_report'), controller_report_extractor('required')),
-                Gauge('mite_runner_count', matcher_by_type('controller_report'), labels_and_value_extractor(['test'], 'num_runners'))
+                Gauge('mite_required_arrival_rate', matcher_by_type('controller_report'), controller_report_extractor('arrival_rates')),
+                ValueCounter('mite_skipped_arrivals_total', matcher_by_type('controller_report'), controller_report_extractor('skipped_arrivals')),
+                ValueCounter('mite_data_reclaimed_total', matcher_by_type('controller_report'), controller_report_extractor('data_reclaimed')),
+                ValueCounter('mite_data_leaked_total', matcher_by_type('controller_report'), controller_report_extractor('data_leaked')),
+                Counter('mite_late_start_total', matcher_by_type('late_start'), labels_extractor('test journey'.split())),
+                Histogram('mite_late_start_seconds', matcher_by_type('late_start'), labels_and_value_extractor(['journey'], 'lag'), [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]),
+                Gauge('mite_runner_count', matcher_by_type('controller_report'), labels_and_value_extractor(['test'], 'num_runners')),
+                Gauge('mite_lagging_runner_count', matcher_by_type('controller_report'), labels_and_value_extractor(['test'], 'num_lagging_runners')),
+                Gauge('mite_runner_loop_lag_p50_seconds', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'loop_lag_p50')),
+                Gauge('mite_runner_loop_lag_p99_seconds', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'loop_lag_p99')),
+                Gauge('mite_runner_loop_lag_max_seconds', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'loop_lag_max')),
+                Gauge('mite_runner_cpu_percent', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'cpu_percent')),
+                Gauge('mite_runner_rss_bytes', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'rss_bytes')),
+                Gauge('mite_runner_capacity', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'capacity', optional=True)),
+                Gauge('mite_runner_in_flight', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'in_flight')),
+                ValueCounter('mite_runner_gc_pause_seconds_total', matcher_by_type('runner_health'), labels_and_value_extractor(runner_key, 'gc_pause')),
+                Gauge('mite_runner_worker_work', matcher_by_type('controller_report'), dict_value_extractor(['test'], 'worker_work', 'worker')),
+                ValueCounter('mite_sender_dropped_messages_total', matcher_by_type('sender_report'), dict_value_extractor(['sender'], 'dropped', 'message_type')),
         ]
 
     def process(self, msg):
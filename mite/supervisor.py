@@ -0,0 +1,230 @@
+from collections import defaultdict, deque
+from itertools import count
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+
+from .config import ConfigManager
+
+logger = logging.getLogger(__name__)
+
+
+class RunnerSupervisor:
+    """Looks like the controller to the worker runners on a host and like one runner to the controller
+
+    Work from the controller queues here until a worker polls for it, each worker getting enough to bring
+    it up to an even share of the host's load. Completed data ids, current work and per worker load are
+    passed upstream in one request_work per loop.
+    """
+    def __init__(self, transport, loop_wait=1, worker_timeout=10, weight=None, loop=None):
+        self._transport = transport
+        self._loop_wait = loop_wait
+        self._worker_timeout = worker_timeout
+        self._weight = weight
+        self._config_manager = ConfigManager()
+        self._pending = deque()
+        self._completed = []
+        self._worker_work = {}
+        self._worker_assumed = {}
+        self._worker_max_work = {}
+        self._worker_last_seen = {}
+        self._worker_shards = {}
+        self._worker_data = {}
+        self._orphaned_shards = defaultdict(list)
+        self._worker_id_gen = count(1)
+        self._runner_id = None
+        self._test_name = None
+        self._partitioned_scenario_ids = []
+        self._stop = False
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+    @property
+    def stopping(self):
+        return self._stop
+
+    def _update_config(self, config_list):
+        for k, v in config_list:
+            self._config_manager.set(k, v)
+
+    def _worker_load(self, runner_id):
+        return sum(self._worker_work[runner_id].values()) + sum(self._worker_assumed[runner_id].values())
+
+    def _worker_loads(self):
+        return {runner_id: self._worker_load(runner_id) for runner_id in self._worker_work}
+
+    def _current_work(self):
+        total = defaultdict(int)
+        for work in self._worker_work.values():
+            for k, v in work.items():
+                total[k] += v
+        for work in self._worker_assumed.values():
+            for k, v in work.items():
+                total[k] += v
+        for received, work_item in self._pending:
+            total[work_item[0]] += 1
+        return dict(total)
+
+    def _max_work(self):
+        if not self._worker_max_work:
+            return 0
+        if None in self._worker_max_work.values():
+            return None
+        return sum(self._worker_max_work.values())
+
+    def _remove_worker(self, runner_id):
+        del self._worker_work[runner_id]
+        del self._worker_assumed[runner_id]
+        del self._worker_max_work[runner_id]
+        del self._worker_last_seen[runner_id]
+        # Data the worker still held goes back to the controller as if completed
+        self._completed.extend(self._worker_data.pop(runner_id, ()))
+        # Shards of a worker that went away without handing them back, whole as we can't know what it used
+        for shard_id, scenario_id in self._worker_shards.pop(runner_id, {}).items():
+            self._orphaned_shards[scenario_id].append((shard_id, None))
+
+    def _expire_workers(self):
+        t = time.time()
+        for runner_id, last_seen in list(self._worker_last_seen.items()):
+            if last_seen + self._worker_timeout < t:
+                logger.warning('Runner worker %s not seen for %ds, forgetting its work', runner_id, self._worker_timeout)
+                self._remove_worker(runner_id)
+
+    def _take_work(self, runner_id, max_work):
+        if not self._pending:
+            return []
+        loads = self._worker_loads()
+        share = math.ceil((sum(loads.values()) + len(self._pending)) / len(loads))
+        n = min(len(self._pending), max(0, share - loads[runner_id]))
+        if max_work is not None:
+            n = min(n, max(0, max_work - loads[runner_id]))
+        work = []
+        t = time.time()
+        assumed = defaultdict(int)
+        data = self._worker_data.setdefault(runner_id, set())
+        for _ in range(n):
+            received, (scenario_id, scenario_data_id, journey_spec, args, start_delay) = self._pending.popleft()
+            if start_delay is not None:
+                # Keep the start time the controller asked for however long this waited here
+                start_delay -= t - received
+            work.append((scenario_id, scenario_data_id, journey_spec, args, start_delay))
+            assumed[scenario_id] += 1
+            if scenario_data_id is not None:
+                data.add((scenario_id, scenario_data_id))
+        self._worker_assumed[runner_id] = assumed
+        return work
+
+    def _abandon_pending(self):
+        # Nobody will run these now, hand their data back to the controller
+        for received, (scenario_id, scenario_data_id, journey_spec, args, start_delay) in self._pending:
+            if scenario_data_id is not None:
+                self._completed.append((scenario_id, scenario_data_id))
+        self._pending.clear()
+
+    def hello(self, weight=None):
+        runner_id = '%s.%d' % (self._runner_id, next(self._worker_id_gen))
+        return (runner_id, self._test_name, self._config_manager.get_changes_for_runner(runner_id),
+                self._partitioned_scenario_ids)
+
+    def request_work(self, runner_id, current_work, completed_data_ids, max_work=None, runner_stats=None):
+        self._worker_work[runner_id] = current_work
+        self._worker_assumed[runner_id] = {}
+        self._worker_max_work[runner_id] = max_work
+        self._worker_last_seen[runner_id] = time.time()
+        data = self._worker_data.get(runner_id, set())
+        for scenario_id, scenario_data_id in completed_data_ids:
+            if (scenario_id, scenario_data_id) in data:
+                data.remove((scenario_id, scenario_data_id))
+                self._completed.append((scenario_id, scenario_data_id))
+        work = self._take_work(runner_id, max_work)
+        return work, self._config_manager.get_changes_for_runner(runner_id), self._stop
+
+    async def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        # Shards are leased to this host as a whole, which worker has which is only known here
+        shards = self._worker_shards.setdefault(runner_id, {})
+        for shard_id, remaining_ids in returned:
+            shards.pop(shard_id, None)
+        shard = await self._transport.lease_data(self._runner_id, scenario_id, returned, lease)
+        if shard is not None:
+            shards[shard[0]] = scenario_id
+        return shard
+
+    def bye(self, runner_id):
+        if runner_id in self._worker_work:
+            self._remove_worker(runner_id)
+
+    async def _return_orphaned_shards(self):
+        orphaned, self._orphaned_shards = self._orphaned_shards, defaultdict(list)
+        for scenario_id, returned in orphaned.items():
+            await self._transport.lease_data(self._runner_id, scenario_id, returned, False)
+
+    async def _request_work(self, max_work):
+        completed, self._completed = self._completed, []
+        work, config_list, stop = await self._transport.request_work(
+            self._runner_id, self._current_work(), completed, max_work, {'worker_work': self._worker_loads()})
+        self._update_config(config_list)
+        received = time.time()
+        self._pending.extend((received, work_item) for work_item in work)
+        return stop
+
+    async def run(self, server):
+        self._runner_id, self._test_name, config_list, self._partitioned_scenario_ids = await self._transport.hello(
+            self._weight)
+        self._update_config(config_list)
+        server_task = asyncio.ensure_future(server.run(self))
+        try:
+            while not self._stop:
+                self._expire_workers()
+                await self._return_orphaned_shards()
+                self._stop = await self._request_work(self._max_work())
+                await asyncio.sleep(self._loop_wait)
+            self._abandon_pending()
+            while self._worker_work:
+                self._expire_workers()
+                await self._return_orphaned_shards()
+                await self._request_work(0)
+                self._abandon_pending()
+                await asyncio.sleep(self._loop_wait)
+            await self._request_work(0)
+            await self._transport.bye(self._runner_id)
+        finally:
+            server_task.cancel()
+
+
+class WorkerProcesses:
+    """Runs target(*args, cpu) in num_processes processes, each pinned to its own core where possible"""
+    def __init__(self, target, args, num_processes):
+        self._context = multiprocessing.get_context('spawn')
+        self._target = target
+        self._args = args
+        self._num_processes = num_processes
+        if hasattr(os, 'sched_getaffinity'):
+            self._cpus = sorted(os.sched_getaffinity(0))
+        else:
+            self._cpus = None
+        self._processes = {}
+
+    def _start(self, index):
+        cpu = self._cpus[index % len(self._cpus)] if self._cpus else None
+        process = self._context.Process(target=self._target, args=self._args + (cpu,), name='mite.runner.%d' % (index,))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self._num_processes):
+            self._start(index)
+
+    def restart_dead(self):
+        for index, process in list(self._processes.items()):
+            if not process.is_alive():
+                logger.warning('Runner worker process %d exited with %r, restarting it', index, process.exitcode)
+                self._start(index)
+
+    def join(self):
+        for process in self._processes.values():
+            process.join()
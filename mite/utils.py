@@ -1,14 +1,149 @@
 import msgpack
 import importlib
+import mmap
+import struct
+import sys
+import threading
+import zlib
+
+from .compact import CompactDecoder
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
-_msg_unpacker = msgpack.Unpacker(encoding='utf-8', use_list=False)
 
 def unpack_msg(msg):
-    _msg_unpacker.feed(msg)
-    return _msg_unpacker.unpack()
-        
-_msg_packer = msgpack.Packer(use_bin_type=True)
-pack_msg = _msg_packer.pack
+    return msgpack.unpackb(msg, encoding='utf-8', use_list=False)
+
+
+def unpack_msgs(msgs):
+    """Unpack every message in a frame of one or more concatenated packed messages"""
+    unpacker = msgpack.Unpacker(encoding='utf-8', use_list=False)
+    unpacker.feed(msgs)
+    return list(unpacker)
+
+
+_local = threading.local()
+
+def pack_msg(msg):
+    try:
+        packer = _local.packer
+    except AttributeError:
+        packer = _local.packer = msgpack.Packer(use_bin_type=True)
+    return packer.pack(msg)
+
+
+# Compressed frames start with 0xc1, a byte msgpack never uses, then the codec and the compressed length.
+# That keeps them distinguishable from plain frames in a receiver and in a collector file full of both.
+_COMPRESSED_MARKER = 0xc1
+_compressed_header = struct.Struct('>BBI')
+_CODEC_ZLIB = 1
+_CODEC_LZ4 = 2
+COMPRESSION_CODECS = {'zlib': _CODEC_ZLIB, 'lz4': _CODEC_LZ4}
+
+# Shared preset dictionary of the strings every message stream repeats, changing it needs a new codec id
+_PRESET_DICT = b''.join(pack_msg(i) for i in [
+    'test', 'runner_id', 'journey', 'context_id', 'scenario_id', 'scenario_data_id', 'transaction', 'type', 'time',
+    'start', 'end', '__root__', 'error', 'exception', 'message', 'ex_type', 'location', 'stacktrace',
+    'http_curl_metrics', 'start_time', 'effective_url', 'response_code', 'dns_time', 'connect_time', 'tls_time',
+    'transfer_start_time', 'first_byte_time', 'total_time', 'primary_ip', 'method', 'GET', 'POST', 'https://',
+])
+
+
+def check_compression_codec(name):
+    if name not in COMPRESSION_CODECS:
+        raise ValueError('Unsupported compression %r, must be one of %r' % (name, sorted(COMPRESSION_CODECS)))
+    if name == 'lz4' and lz4 is None:
+        raise ValueError('lz4 compression needs the lz4 package installed')
+    return COMPRESSION_CODECS[name]
+
+
+def compress_frame(frame, codec):
+    if codec == _CODEC_ZLIB:
+        compressor = zlib.compressobj(zdict=_PRESET_DICT)
+        payload = compressor.compress(frame) + compressor.flush()
+    else:
+        payload = lz4.block.compress(frame, dict=_PRESET_DICT)
+    return _compressed_header.pack(_COMPRESSED_MARKER, codec, len(payload)) + payload
+
+
+def _decompress_payload(codec, payload):
+    if codec == _CODEC_ZLIB:
+        decompressor = zlib.decompressobj(zdict=_PRESET_DICT)
+        return decompressor.decompress(payload) + decompressor.flush()
+    elif codec == _CODEC_LZ4:
+        return lz4.block.decompress(payload, dict=_PRESET_DICT)
+    raise ValueError('Unknown compression codec %r' % (codec,))
+
+
+def decompress_frame(raw):
+    """Returns the packed messages in raw, which may or may not be a compressed frame"""
+    if not raw or raw[0] != _COMPRESSED_MARKER:
+        return raw
+    _, codec, length = _compressed_header.unpack_from(raw)
+    return _decompress_payload(codec, raw[_compressed_header.size:_compressed_header.size + length])
+
+
+def _interned_dict(pairs):
+    return {sys.intern(k) if type(k) is str else k: v for k, v in pairs}
+
+
+class StreamDecoder:
+    """Turns frames, or whole files of them, into messages one at a time
+
+    Each receiver should have its own, it keeps the unpacker buffer and the compact header tables for
+    the streams it reads. Compressed frames are expanded and compact records turned back into dicts.
+    intern_keys shares one str object per distinct key across every message, at some cost in speed.
+    """
+    def __init__(self, intern_keys=False):
+        self._unpacker_kwargs = {'encoding': 'utf-8', 'use_list': False}
+        if intern_keys:
+            self._unpacker_kwargs['object_pairs_hook'] = _interned_dict
+        self._unpacker = msgpack.Unpacker(**self._unpacker_kwargs)
+        self._compact_decoder = CompactDecoder()
+
+    def _drain(self):
+        decode = self._compact_decoder.decode
+        for obj in self._unpacker:
+            msg = decode(obj)
+            if msg is not None:
+                yield msg
+
+    def decode_frame(self, raw):
+        """Yield the messages in raw, one frame as sent by a Sender"""
+        self._unpacker.feed(decompress_frame(raw))
+        return self._drain()
+
+    def decode_stream(self, data):
+        """Yield the messages in data, a run of plain and compressed frames such as a collector file"""
+        decode = self._compact_decoder.decode
+        pos = 0
+        while pos < len(data):
+            if data[pos] == _COMPRESSED_MARKER:
+                _, codec, length = _compressed_header.unpack_from(data, pos)
+                pos += _compressed_header.size
+                self._unpacker.feed(_decompress_payload(codec, data[pos:pos + length]))
+                yield from self._drain()
+                pos += length
+                continue
+            # Plain frames run until the next compressed one, which can only start at a message boundary
+            unpacker = msgpack.Unpacker(**self._unpacker_kwargs)
+            unpacker.feed(data[pos:])
+            start = pos
+            while pos < len(data) and data[pos] != _COMPRESSED_MARKER:
+                msg = decode(unpacker.unpack())
+                pos = start + unpacker.tell()
+                if msg is not None:
+                    yield msg
+
+    def decode_file(self, path):
+        with open(path, 'rb') as f:
+            if not f.seek(0, 2):
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield from self.decode_stream(data)
 
 
 def spec_import(spec):
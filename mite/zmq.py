@@ -1,38 +1,143 @@
 import zmq
+import zmq.asyncio
 
-from .utils import pack_msg, unpack_msg
+from .utils import pack_msg, unpack_msg, check_compression_codec, compress_frame, StreamDecoder
+from .compact import CompactEncoder
+from collections import defaultdict, deque, OrderedDict
+from itertools import count
 import asyncio
 import logging
+import queue
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on frames handled per wakeup so a busy socket can't starve other loop callbacks
+_MAX_DRAIN = 1000
+
+
+class _DuplicatorOutput:
+    def __init__(self, zmq_context, address, max_queue):
+        self.address = address
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._socket = zmq_context.socket(zmq.PUSH)
+        self._socket.bind(address)
+        # The socket is only used from this thread from here on
+        self._thread = threading.Thread(target=self._run, name='mite.duplicator %s' % (address,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, frame):
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            self._socket.send(frame, copy=False)
+
 
 class Duplicator:
-    def __init__(self, in_address, out_addresses, loop=None):
-        self._zmq_context = zmq.Context()
+    def __init__(self, in_address, out_addresses, max_queue=10000, loop=None):
+        self._zmq_context = zmq.asyncio.Context()
         self._in_socket = self._zmq_context.socket(zmq.PULL)
         self._in_socket.bind(in_address)
-        self._out_sockets = [self._zmq_context.socket(zmq.PUSH) for i in out_addresses]
-        for socket, address in zip(self._out_sockets, out_addresses):
-            socket.bind(address)
+        self._out_zmq_context = zmq.Context()
+        self._outputs = [_DuplicatorOutput(self._out_zmq_context, address, max_queue) for address in out_addresses]
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
 
+    def output_stats(self):
+        return [(output.address, output.depth(), output.dropped) for output in self._outputs]
+
+    def _send(self, frame):
+        # Every output shares the one received frame, zmq reference counts the buffer rather than copying it
+        for output in self._outputs:
+            output.put(frame)
+
     async def run(self, stop_func=None):
-        return await self._loop.run_in_executor(None, self._run, stop_func)
+        try:
+            while stop_func is None or not stop_func():
+                self._send(await self._in_socket.recv(copy=False))
+                for _ in range(_MAX_DRAIN):
+                    try:
+                        frame = self._in_socket.recv(zmq.NOBLOCK, copy=False).result()
+                    except zmq.Again:
+                        break
+                    self._send(frame)
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            for output in self._outputs:
+                output.close()
+
+
+class Forwarder:
+    """Merges everything sent to in_address into one connection to out_address"""
+    def __init__(self, in_address, out_address):
+        self._zmq_context = zmq.Context()
+        self._in_socket = self._zmq_context.socket(zmq.PULL)
+        self._in_socket.bind(in_address)
+        self._out_socket = self._zmq_context.socket(zmq.PUSH)
+        self._out_socket.connect(out_address)
+        self._thread = threading.Thread(target=zmq.proxy, args=(self._in_socket, self._out_socket),
+                                        name='mite.forwarder %s' % (out_address,))
+        self._thread.daemon = True
 
-    def _run(self, stop_func=None):
-        while stop_func is None or not stop_func():
-            msg = self._in_socket.recv()
-            for socket in self._out_sockets:
-                socket.send(msg)
+    def start(self):
+        self._thread.start()
+
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
 
 
 class Sender:
-    def __init__(self):
+    def __init__(self, batch_size=1, batch_delay=0, compact=False, compression=None, hwm=1000, overflow='block',
+                 loop=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unsupported overflow policy %r, must be one of %r' % (overflow, OVERFLOW_POLICIES))
         self._zmq_context = zmq.Context()
         self._socket = self._zmq_context.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.SNDHWM, hwm)
+        if overflow != 'block':
+            # Don't hang on exit waiting to deliver telemetry we'd be happy to drop anyway
+            self._socket.setsockopt(zmq.LINGER, 1000)
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._batch = []
+        self._batch_types = []
+        if compact:
+            self._encoder = CompactEncoder()
+            self._frame_start = pack_msg(self._encoder.frame_start())
+        else:
+            self._encoder = None
+            self._frame_start = b''
+        if compression is not None:
+            self._compression = check_compression_codec(compression)
+        else:
+            self._compression = None
+        self._overflow = overflow
+        # With drop-oldest, frames zmq won't take yet wait here and the oldest are dropped once it's full
+        self._pending = deque()
+        self._max_pending = hwm
+        self._retry_handle = None
+        self.dropped = defaultdict(int)
+        self._flush_handle = None
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
 
     def bind(self, address):
         self._socket.bind(address)
@@ -40,13 +145,75 @@ class Sender:
     def connect(self, address):
         self._socket.connect(address)
 
+    def _pack(self, msg):
+        if self._encoder is None:
+            return pack_msg(msg)
+        return b''.join([pack_msg(record) for record in self._encoder.encode(msg)])
+
+    def _drop(self, msg_types):
+        for msg_type in msg_types:
+            self.dropped[msg_type] += 1
+        if self._encoder is not None:
+            # Later messages may need header definitions that were in the dropped frame
+            self._encoder.reset()
+
+    def _retry_pending(self):
+        self._retry_handle = None
+        self._send_pending()
+
+    def _send_pending(self):
+        while self._pending:
+            try:
+                self._socket.send(self._pending[0][0], zmq.NOBLOCK)
+            except zmq.Again:
+                if self._retry_handle is None:
+                    self._retry_handle = self._loop.call_later(0.01, self._retry_pending)
+                return
+            self._pending.popleft()
+
+    def _send_frame(self, frame, msg_types):
+        if self._compression is not None:
+            frame = compress_frame(frame, self._compression)
+        if self._overflow == 'block':
+            self._socket.send(frame)
+        elif self._overflow == 'drop-newest':
+            try:
+                self._socket.send(frame, zmq.NOBLOCK)
+            except zmq.Again:
+                self._drop(msg_types)
+        else:
+            if len(self._pending) >= self._max_pending:
+                self._drop(self._pending.popleft()[1])
+            self._pending.append((frame, msg_types))
+            self._send_pending()
+
     def send(self, msg):
-        self._socket.send(pack_msg(msg))
+        msg_type = msg.get('type', '') if type(msg) is dict else ''
+        if self._batch_size <= 1:
+            self._send_frame(self._frame_start + self._pack(msg), (msg_type,))
+            return
+        self._batch.append(self._pack(msg))
+        self._batch_types.append(msg_type)
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(self._batch_delay, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._batch:
+            # msgpack is self delimiting so a batch is just the packed messages back to back
+            self._send_frame(self._frame_start + b''.join(self._batch), self._batch_types)
+            self._batch = []
+            self._batch_types = []
+        self._send_pending()
 
 
 class Receiver:
     def __init__(self, listeners=None, raw_listeners=None, loop=None):
-        self._zmq_context = zmq.Context()
+        self._zmq_context = zmq.asyncio.Context()
         self._socket = self._zmq_context.socket(zmq.PULL)
         if listeners is None:
             listeners = []
@@ -54,6 +221,7 @@ class Receiver:
         if raw_listeners is None:
             raw_listeners = []
         self._raw_listeners = raw_listeners
+        self._decoder = StreamDecoder()
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
@@ -70,80 +238,203 @@ class Receiver:
     def add_raw_listener(self, listener):
         self._raw_listeners.append(listener)
 
-    def _recv(self):
-        return self._socket.recv()
+    async def _recv(self):
+        return await self._socket.recv()
 
-    async def run(self, stop_func=None):
-        return await self._loop.run_in_executor(None, self._run, stop_func)
+    def _recv_nowait(self):
+        return self._socket.recv(zmq.NOBLOCK).result()
 
-    def _run(self, stop_func=None):
-        while stop_func is None or not stop_func():
-            raw = self._recv()
-            for raw_listener in self._raw_listeners:
-                raw_listener(raw)
-            msg = unpack_msg(raw)
+    def _process(self, raw):
+        for raw_listener in self._raw_listeners:
+            raw_listener(raw)
+        if not self._listeners:
+            return
+        for msg in self._decoder.decode_frame(raw):
             for listener in self._listeners:
                 listener(msg)
 
+    async def run(self, stop_func=None):
+        while stop_func is None or not stop_func():
+            self._process(await self._recv())
+            # Handle everything already queued before going back to the loop
+            for _ in range(_MAX_DRAIN):
+                try:
+                    raw = self._recv_nowait()
+                except zmq.Again:
+                    break
+                self._process(raw)
+            else:
+                await asyncio.sleep(0)
+
 
 _MSG_TYPE_HELLO = 1
 _MSG_TYPE_REQUEST_WORK = 2
 _MSG_TYPE_BYE = 3
+_MSG_TYPE_SUBSCRIBE = 4
+_MSG_TYPE_REPORT_WORK = 5
+_MSG_TYPE_LEASE_DATA = 6
+
+# Request ids start at 1, a reply with this id is work pushed to a subscribed runner
+_PUSH_ID = 0
 
 
 class RunnerTransport:
-    def __init__(self, socket_address, loop=None):
-        self._zmq_context = zmq.Context()
-        self._sock = self._zmq_context.socket(zmq.REQ)
+    def __init__(self, socket_address, timeout=5, retries=3, loop=None):
+        self._zmq_context = zmq.asyncio.Context()
+        self._sock = self._zmq_context.socket(zmq.DEALER)
+        self._sock.setsockopt(zmq.LINGER, 0)
         self._sock.connect(socket_address)
+        self._request_id_gen = count(1)
+        self._timeout = timeout
+        self._retries = retries
+        self._replies = {}
+        self._pushes = asyncio.Queue()
+        self._reader = None
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
 
-    def _hello(self):
-        self._sock.send(pack_msg((_MSG_TYPE_HELLO, None)))
-        return unpack_msg(self._sock.recv())
+    async def _read(self):
+        # Pushes can arrive at any time so one task reads everything and hands replies to their requests
+        while True:
+            reply_id, result = unpack_msg(await self._sock.recv())
+            if reply_id == _PUSH_ID:
+                self._pushes.put_nowait(result)
+                continue
+            future = self._replies.pop(reply_id, None)
+            if future is None or future.done():
+                logger.debug('Discarding stale controller reply for request %r', reply_id)
+            else:
+                future.set_result(result)
+
+    async def _request(self, _type, content):
+        if self._reader is None:
+            self._reader = self._loop.create_task(self._read())
+        request_id = next(self._request_id_gen)
+        msg = pack_msg((request_id, _type, content))
+        future = self._loop.create_future()
+        self._replies[request_id] = future
+        try:
+            for attempt in range(self._retries + 1):
+                await self._sock.send(msg)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), self._timeout)
+                except asyncio.TimeoutError:
+                    if attempt == self._retries:
+                        raise
+                    logger.warning('Controller request %d type %d timed out after %.1fs, retrying (%d/%d)',
+                                   request_id, _type, self._timeout, attempt + 1, self._retries)
+        finally:
+            self._replies.pop(request_id, None)
+
+    async def hello(self, weight=None):
+        return await self._request(_MSG_TYPE_HELLO, weight)
+
+    async def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        return await self._request(_MSG_TYPE_REQUEST_WORK,
+                                   [runner_id, current_work, completed_data_ids, max_work, runner_stats])
 
-    async def hello(self):
-        return await self._loop.run_in_executor(None, self._hello)
-
-    def _request_work(self, runner_id, current_work, completed_data_ids, max_work):
-        self._sock.send(pack_msg((_MSG_TYPE_REQUEST_WORK, [runner_id, current_work, completed_data_ids, max_work])))
-        msg = self._sock.recv()
-        result = unpack_msg(msg)
+    async def bye(self, runner_id):
+        result = await self._request(_MSG_TYPE_BYE, runner_id)
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
         return result
 
-    async def request_work(self, runner_id, current_work, completed_data_ids, max_work):
-        return await self._loop.run_in_executor(None, self._request_work, runner_id, current_work, completed_data_ids, max_work)
+    async def subscribe(self, runner_id, max_work):
+        return await self._request(_MSG_TYPE_SUBSCRIBE, [runner_id, max_work])
 
-    def _bye(self, runner_id):
-        self._sock.send(pack_msg((_MSG_TYPE_BYE, runner_id)))
-        return unpack_msg(self._sock.recv())
+    async def report_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        return await self._request(_MSG_TYPE_REPORT_WORK,
+                                   [runner_id, current_work, completed_data_ids, max_work, runner_stats])
 
-    async def bye(self, runner_id):
-        return await self._loop.run_in_executor(None, self._request_work, runner_id)
+    async def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        return await self._request(_MSG_TYPE_LEASE_DATA, [runner_id, scenario_id, returned, lease])
+
+    async def next_push(self):
+        return await self._pushes.get()
 
 
 class ControllerServer:
-    def __init__(self, socket_address, loop=None):
-        self._zmq_context = zmq.Context()
-        self._sock = self._zmq_context.socket(zmq.REP)
+    """Serves runners over a ROUTER socket
+
+    The last reply to each runner is kept so a retried request isn't handled twice. Replies are kept in the
+    order they were sent and forgotten on bye or once the runner has been quiet for reply_ttl, longer than
+    any runner keeps retrying.
+    """
+    def __init__(self, socket_address, push_interval=0.01, reply_ttl=60, loop=None):
+        self._zmq_context = zmq.asyncio.Context()
+        self._sock = self._zmq_context.socket(zmq.ROUTER)
         self._sock.bind(socket_address)
+        self._last_replies = OrderedDict()
+        self._reply_ttl = reply_ttl
+        self._subscribers = {}
+        self._push_interval = push_interval
+        self._next_push = 0
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
 
-    async def run(self, controller, stop_func=None):
-        return await self._loop.run_in_executor(None, self._run, controller, stop_func)
+    def _handle(self, controller, identity, _type, content):
+        if _type == _MSG_TYPE_HELLO:
+            return controller.hello(content)
+        elif _type == _MSG_TYPE_REQUEST_WORK:
+            return controller.request_work(*content)
+        elif _type == _MSG_TYPE_REPORT_WORK:
+            return controller.report_work(*content)
+        elif _type == _MSG_TYPE_SUBSCRIBE:
+            self._subscribers[content[0]] = identity
+            return controller.subscribe(*content)
+        elif _type == _MSG_TYPE_LEASE_DATA:
+            return controller.lease_data(*content)
+        elif _type == _MSG_TYPE_BYE:
+            self._subscribers.pop(content, None)
+            return controller.bye(content)
+
+    async def _handle_request(self, controller):
+        identity, raw = await self._sock.recv_multipart()
+        request_id, _type, content = unpack_msg(raw)
+        last = self._last_replies.get(identity)
+        if last is not None and last[0] == request_id:
+            # A retry of a request we already handled, the runner lost our reply so don't do the work twice
+            reply = last[1]
+        else:
+            result = self._handle(controller, identity, _type, content)
+            if asyncio.iscoroutine(result):
+                # A supervisor passing the request on to its own controller
+                result = await result
+            reply = pack_msg((request_id, result))
+            if _type == _MSG_TYPE_BYE:
+                self._last_replies.pop(identity, None)
+            else:
+                self._last_replies[identity] = (request_id, reply, self._loop.time())
+                self._last_replies.move_to_end(identity)
+        self._expire_replies()
+        await self._sock.send_multipart([identity, reply])
+
+    def _expire_replies(self):
+        expiry = self._loop.time() - self._reply_ttl
+        while self._last_replies:
+            identity, (request_id, reply, t) = next(iter(self._last_replies.items()))
+            if t > expiry:
+                break
+            del self._last_replies[identity]
+
+    async def _push(self, controller):
+        now = self._loop.time()
+        if now < self._next_push:
+            return
+        self._next_push = now + self._push_interval
+        for runner_id, push in controller.get_pushes():
+            identity = self._subscribers.get(runner_id)
+            if identity is not None:
+                await self._sock.send_multipart([identity, pack_msg((_PUSH_ID, push))])
 
-    def _run(self, controller, stop_func=None):
+    async def run(self, controller, stop_func=None):
         while stop_func is None or not stop_func():
-            _type, content = unpack_msg(self._sock.recv())
-            if _type == _MSG_TYPE_HELLO:
-                self._sock.send(pack_msg(controller.hello()))
-            elif _type == _MSG_TYPE_REQUEST_WORK:
-                self._sock.send(pack_msg(controller.request_work(*content)))
-            elif _type == _MSG_TYPE_BYE:
-                self._sock.send(pack_msg(controller.bye(content)))
-
-
+            if not self._subscribers:
+                await self._handle_request(controller)
+                continue
+            if await self._sock.poll(self._push_interval * 1000, zmq.POLLIN):
+                await self._handle_request(controller)
+            await self._push(controller)
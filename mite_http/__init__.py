@@ -45,6 +45,7 @@ class SessionPool:
                 transfer_start_time=r.pretransfer_time,
                 first_byte_time=r.starttransfer_time,
                 total_time=r.total_time,
+                corrected_total_time=r.total_time + context.start_lag,
                 primary_ip=r.primary_ip,
                 method=r.request.method
             )
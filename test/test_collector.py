@@ -0,0 +1,20 @@
+import os
+
+from mite.collector import Collector
+from mite.utils import pack_msg
+
+
+def test_files_roll_by_messages_not_frames(tmp_path):
+    collector = Collector(str(tmp_path), roll_after_n_messages=10)
+    frame = b''.join(pack_msg({'type': 'start', 'n': i}) for i in range(4))
+    for _ in range(3):
+        collector.process_raw_message(frame)
+    assert len([fn for fn in os.listdir(str(tmp_path)) if fn.replace('_', '').isdigit()]) == 1
+    assert collector._msg_count == 0
+
+
+def test_data_created_is_written_from_frames(tmp_path):
+    collector = Collector(str(tmp_path))
+    collector.process_raw_message(pack_msg({'type': 'data_created', 'name': 'users', 'data': [1, 2]}))
+    with open(os.path.join(str(tmp_path), 'users.msgpack'), 'rb') as f:
+        assert f.read() == pack_msg([1, 2])
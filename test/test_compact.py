@@ -0,0 +1,38 @@
+from mite.compact import CompactEncoder, CompactDecoder
+from mite.utils import pack_msg, unpack_msgs
+
+
+def _msg(msg_type, context_id, **fields):
+    msg = {'test': 'test', 'runner_id': 1, 'journey': 'mite.example:journey', 'context_id': context_id,
+           'scenario_id': 1, 'scenario_data_id': None, 'transaction': 'test1', 'type': msg_type, 'time': 1.5}
+    msg.update(fields)
+    return msg
+
+
+def _roundtrip(encoder, decoder, msgs):
+    frame = pack_msg(encoder.frame_start()) + b''.join(pack_msg(r) for m in msgs for r in encoder.encode(m))
+    return [m for m in (decoder.decode(o) for o in unpack_msgs(frame)) if m is not None]
+
+
+def test_roundtrip():
+    msgs = [
+        _msg('start', 1),
+        _msg('test_message', 1, content='Not set'),
+        _msg('end', 1),
+        {'type': 'controller_report', 'time': 1.5, 'required': {}},
+    ]
+    assert _roundtrip(CompactEncoder(), CompactDecoder(), msgs) == msgs
+
+
+def test_headers_sent_once_per_context():
+    encoder = CompactEncoder()
+    assert len(encoder.encode(_msg('start', 1))) == 2
+    assert len(encoder.encode(_msg('end', 1))) == 1
+    assert len(encoder.encode(_msg('start', 2))) == 2
+
+
+def test_oldest_headers_forgotten_in_step():
+    encoder = CompactEncoder(max_headers=2)
+    decoder = CompactDecoder(max_headers=2)
+    msgs = [_msg('start', i) for i in (1, 2, 3, 1)]
+    assert _roundtrip(encoder, decoder, msgs) == msgs
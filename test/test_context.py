@@ -0,0 +1,20 @@
+import asyncio
+
+from mite.context import Context
+
+
+def test_transaction_messages_carry_corrected_times():
+    msgs = []
+    ctx = Context(msgs.append, {}, id_data={'test': 'test'})
+    ctx._start_lag = 0.5
+
+    async def journey():
+        async with ctx.transaction('test1'):
+            pass
+
+    asyncio.new_event_loop().run_until_complete(journey())
+    start, end = msgs
+    assert start['type'] == 'start' and end['type'] == 'end'
+    assert start['intended_time'] == start['time'] - 0.5
+    assert end['duration'] == end['time'] - start['time']
+    assert end['corrected_duration'] == end['duration'] + 0.5
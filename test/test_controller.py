@@ -0,0 +1,97 @@
+import time
+
+from mite.controller import Controller
+from mite.scenario import ScenarioManager, StopScenario
+from mite.config import ConfigManager
+from mite.datapools import RecyclableIterableDataPool
+
+
+def _controller(volumemodel, **kwargs):
+    scenario_manager = ScenarioManager()
+    scenario_manager.add_scenario('mite.example:journey', None, volumemodel)
+    return Controller('test', scenario_manager, ConfigManager(), **kwargs)
+
+
+def test_pushes_required_work_to_subscribers():
+    controller = _controller(lambda start, end: 10)
+    runner_ids = [controller.hello()[0] for _ in range(2)]
+    for runner_id in runner_ids:
+        controller.subscribe(runner_id)
+    pushes = dict(controller.get_pushes())
+    assert sorted(pushes) == runner_ids
+    assert sum(len(work) for work, config_list, stop in pushes.values()) == 10
+    # Volume is met so there's nothing more to push until work completes
+    assert controller.get_pushes() == []
+    controller.report_work(runner_ids[0], {1: 2}, [])
+    pushes = dict(controller.get_pushes())
+    assert list(pushes) == [runner_ids[0]]
+    assert len(pushes[runner_ids[0]][0]) == 3
+
+
+def test_pushes_stop_once():
+    def volumemodel(start, end):
+        raise StopScenario()
+    controller = _controller(volumemodel)
+    runner_id = controller.hello()[0]
+    controller.subscribe(runner_id)
+    assert controller.get_pushes() == [(runner_id, ([], [], True))]
+    assert controller.get_pushes() == []
+
+
+def test_lagging_runner_gets_no_work():
+    controller = _controller(lambda start, end: 10, runner_max_lag=0.5)
+    lagging, healthy = [controller.hello()[0] for _ in range(2)]
+    work, config_list, stop = controller.request_work(lagging, {}, [], None, {'loop_lag': 1.0})
+    assert work == []
+    work, config_list, stop = controller.request_work(healthy, {}, [], None, {'loop_lag': 0.01})
+    assert len(work) == 10
+
+
+def test_work_is_shared_by_capacity():
+    controller = _controller(lambda start, end: 40)
+    big, small = [controller.hello()[0] for _ in range(2)]
+    controller.report_work(big, {}, [], 30)
+    controller.report_work(small, {}, [], 10)
+    assert len(controller.request_work(big, {}, [], 30)[0]) == 30
+    assert len(controller.request_work(small, {}, [], 10)[0]) == 10
+
+
+def test_work_is_shared_by_weight():
+    controller = _controller(lambda start, end: 40)
+    big = controller.hello(weight=3)[0]
+    small = controller.hello(weight=1)[0]
+    assert len(controller.request_work(small, {}, [], None)[0]) == 10
+    assert len(controller.request_work(big, {}, [], None)[0]) == 30
+    controller.bye(big)
+    # The leaver's share goes to those left as soon as it's gone
+    assert len(controller.request_work(small, {1: 10}, [], None)[0]) == 30
+
+
+def test_expired_runners_work_is_given_to_others():
+    controller = _controller(lambda start, end: 10)
+    controller._runner_tracker._timeout = 0.05
+    gone, staying = [controller.hello()[0] for _ in range(2)]
+    assert len(controller.request_work(gone, {}, [])[0]) == 5
+    time.sleep(0.1)
+    assert len(controller.request_work(staying, {}, [])[0]) == 10
+    assert list(controller._runner_tracker.get_active()) == [staying]
+
+
+def test_data_held_by_expired_runners_is_reclaimed():
+    datapool = RecyclableIterableDataPool('abcd')
+    scenario_manager = ScenarioManager()
+    scenario_manager.add_scenario('mite.example:journey', datapool, lambda start, end: 4)
+    controller = Controller('test', scenario_manager, ConfigManager())
+    controller._runner_tracker._timeout = 0.05
+    gone, staying = [controller.hello()[0] for _ in range(2)]
+    assert len(controller.request_work(gone, {}, [])[0]) == 2
+    time.sleep(0.1)
+    work = controller.request_work(staying, {}, [])[0]
+    assert sorted(args for scenario_id, scenario_data_id, journey_spec, args, start_delay in work) == ['a', 'b', 'c', 'd']
+    # It was only slow, what it completes now has already been given to someone else
+    controller.request_work(gone, {}, [(1, 1), (1, 2)])
+    assert datapool.checkout() is None
+    reports = []
+    controller.report(reports.append)
+    assert reports[0]['data_reclaimed'] == {1: 2}
+    assert reports[0]['data_leaked'] == {}
@@ -1,4 +1,8 @@
-from mite.datapools import create_iterable_data_pool_with_recycling, create_iterable_data_pool, DataPoolExhausted
+import os
+
+from mite.datapools import create_iterable_data_pool_with_recycling, create_iterable_data_pool, DataPoolExhausted, \
+    PartitionedDataPool, ShardedDataPoolProxy, FileDataPool, IterableFactoryDataPool, SQLiteDataPool
+from mite.utils import pack_msg
 
 def test_recycling():
     iterable = 'abcdefgh'
@@ -25,3 +29,156 @@ def test_iterable():
         assert False, "Data pool should have been exhausted"
 
 
+
+
+def test_partitioned_leases_shards():
+    dp = PartitionedDataPool('abcde', shard_size=2)
+    assert dp.lease(1) == (1, [(1, 'a'), (2, 'b')], True)
+    assert dp.lease(2) == (2, [(3, 'c'), (4, 'd')], True)
+    assert dp.lease(1) == (3, [(5, 'e')], True)
+    assert dp.lease(2) is None
+    # Only the runner holding a shard can hand it back
+    dp.release(2, 1)
+    assert dp.lease(2) is None
+    dp.release_runner(1)
+    assert sorted(dp.lease(2)[0] for _ in range(2)) == [1, 3]
+
+
+def test_partitioned_without_recycling_is_used_once():
+    dp = PartitionedDataPool('abcde', shard_size=2, recycle=False)
+    proxy = ShardedDataPoolProxy()
+    used = []
+    shard = dp.lease(1)
+    while shard is not None:
+        proxy.add_shard(*shard)
+        dpi = proxy.checkout()
+        while dpi is not None:
+            used.append(dpi.data)
+            proxy.checkin(dpi.id)
+            dpi = proxy.checkout()
+        for shard_id, remaining_ids in proxy.pop_returned():
+            dp.release(1, shard_id, remaining_ids)
+        shard = dp.lease(1)
+    assert used == list('abcde')
+    assert dp.exhausted
+
+
+def test_sharded_proxy_hands_back_idle_shards():
+    proxy = ShardedDataPoolProxy()
+    proxy.add_shard(1, [(1, 'a'), (2, 'b')], True)
+    proxy.add_shard(2, [(3, 'c'), (4, 'd')], True)
+    first, second = proxy.checkout(), proxy.checkout()
+    assert (first.data, second.data) == ('a', 'b')
+    proxy.checkin(first.id)
+    assert proxy.pop_returned() == []
+    proxy.checkin(second.id)
+    assert proxy.pop_returned() == [(1, [1, 2])]
+    assert proxy.checkout().data == 'c'
+
+
+def test_file_recycles_in_order(tmp_path):
+    path = str(tmp_path / 'data.jsonl')
+    with open(path, 'w') as f:
+        f.write('[1, "a"]\n\n[2, "b"]\n[3, "c"]')
+    dp = FileDataPool(path)
+    first, second = dp.checkout(), dp.checkout()
+    assert (first.data, second.data) == ([1, 'a'], [2, 'b'])
+    dp.checkin(first.id)
+    assert dp.checkout().data == [3, 'c']
+    assert dp.checkout() == first
+    assert dp.checkout() is None
+
+
+def test_file_csv_with_header(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    with open(path, 'w') as f:
+        f.write('user,password\r\nalice,"x,y"\r\nbob,z\r\n')
+    dp = FileDataPool(path, recycle=False, header=True)
+    assert [dp.checkout().data for _ in range(len(dp))] == [['alice', 'x,y'], ['bob', 'z']]
+    try:
+        dp.checkout()
+    except DataPoolExhausted:
+        pass
+    else:
+        assert False, "Data pool should have been exhausted"
+
+
+def test_file_index_is_reused_until_the_file_changes(tmp_path):
+    path = str(tmp_path / 'data.msgpack')
+    with open(path, 'wb') as f:
+        f.write(b''.join(pack_msg((i, 'user%d' % i)) for i in range(100)))
+    assert FileDataPool(path).checkout().data == (0, 'user0')
+    index_mtime = os.stat(path + '.idx').st_mtime_ns
+    dp = FileDataPool(path)
+    assert os.stat(path + '.idx').st_mtime_ns == index_mtime
+    assert len(dp) == 100
+    with open(path, 'ab') as f:
+        f.write(pack_msg((100, 'user100')))
+    assert len(FileDataPool(path)) == 101
+
+
+def test_iterable_factory_reuses_free_ids():
+    calls = []
+    def factory():
+        calls.append(1)
+        return 'abc'
+    dp = IterableFactoryDataPool(factory)
+    assert [dpi.data for dpi in dp.checkout_many(2)] == ['a', 'b']
+    dpi = dp.checkout()
+    assert dpi.data == 'c'
+    assert dp.checkout() is None
+    assert dp.checkout_many(2) == []
+    dp.checkin(dpi.id)
+    assert dp.checkout() == dpi
+    assert len(calls) == 1
+
+
+def test_iterable_checkout_many_runs_out():
+    dp = create_iterable_data_pool('abc')
+    assert [dpi.data for dpi in dp.checkout_many(2)] == ['a', 'b']
+    assert [dpi.data for dpi in dp.checkout_many(2)] == ['c']
+    try:
+        dp.checkout_many(2)
+    except DataPoolExhausted:
+        pass
+    else:
+        assert False, "Data pool should have been exhausted"
+
+
+def _crash(dp):
+    # Stop the background thread without recording anything, as if the process had died
+    dp._closed = True
+    dp._wakeup.set()
+    dp._thread.join()
+
+
+def test_sqlite_resumes_where_it_left_off(tmp_path):
+    path = str(tmp_path / 'data.db')
+    dp = SQLiteDataPool(path, ([i] for i in range(25)), block_size=100)
+    dpis = dp.checkout_many(12)
+    assert [dpi.data for dpi in dpis] == [(i,) for i in range(12)]
+    for dpi in dpis:
+        dp.checkin(dpi.id)
+    dp.close()
+    dp = SQLiteDataPool(path, 'ignored', block_size=100)
+    assert [dpi.data for dpi in dp.checkout_many(20)] == [(i,) for i in range(12, 25)]
+    try:
+        dp.checkout()
+    except DataPoolExhausted:
+        pass
+    else:
+        assert False, "Data pool should have been exhausted"
+    dp.close()
+
+
+def test_sqlite_never_hands_out_claimed_rows_after_a_crash(tmp_path):
+    path = str(tmp_path / 'data.db')
+    dp = SQLiteDataPool(path, ([i] for i in range(25)), block_size=10)
+    assert dp.checkout().data == (0,)
+    _crash(dp)
+    dp = SQLiteDataPool(path, block_size=10)
+    assert dp.checkout().data == (10,)
+    _crash(dp)
+    dp = SQLiteDataPool(path, block_size=10, resume_checked_out=True)
+    assert dp.checkout().data == (0,)
+    dp.close()
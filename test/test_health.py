@@ -0,0 +1,27 @@
+from mite.health import CapacityController
+
+
+class _Sampler:
+    lag = 0
+    cpu = 0
+
+    def recent_lag(self):
+        return self.lag
+
+    def recent_cpu_percent(self):
+        return self.cpu
+
+
+def test_capacity_aimd():
+    sampler = _Sampler()
+    capacity = CapacityController(sampler, initial=10, increase=5, decrease=0.5, period=0)
+    assert capacity.capacity(10) == 20
+    assert capacity.capacity(20) == 40
+    # Unused capacity isn't grown
+    assert capacity.capacity(5) == 40
+    sampler.lag = 1
+    assert capacity.capacity(40) == 20
+    sampler.lag = 0
+    assert capacity.capacity(20) == 25
+    sampler.cpu = 100
+    assert capacity.capacity(25) == 12
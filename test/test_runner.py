@@ -0,0 +1,83 @@
+import asyncio
+
+from mite.controller import Controller
+from mite.config import ConfigManager
+from mite.datapools import PartitionedDataPool
+from mite.runner import Runner
+from mite.scenario import ScenarioManager
+
+ran = []
+
+
+async def journey(ctx, arg):
+    ran.append((id(ctx), ctx._id_data['context_id'], arg))
+    await asyncio.sleep(0)
+
+
+class _Transport:
+    def __init__(self, batches):
+        self._batches = batches
+        self.completed = []
+
+    async def hello(self, weight=None):
+        return 1, 'test', [], []
+
+    async def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        self.completed.extend(completed_data_ids)
+        if current_work or not self._batches:
+            return [], [], not self._batches and not current_work
+        return self._batches.pop(0), [], False
+
+    async def bye(self, runner_id):
+        pass
+
+
+def test_virtual_users_reuse_contexts():
+    del ran[:]
+    journey_spec = __name__ + ':journey'
+    batches = [[(1, i, journey_spec, (i,), None) for i in range(n, n + 5)] for n in (0, 5)]
+    transport = _Transport(batches)
+    loop = asyncio.new_event_loop()
+    runner = Runner(transport, lambda msg: None, loop_wait_min=0, loop_wait_max=0.01, loop=loop, virtual_users=True)
+    loop.run_until_complete(runner.run())
+    loop.close()
+    assert sorted(arg for ctx_id, context_id, arg in ran) == list(range(10))
+    assert sorted(transport.completed) == [(1, i) for i in range(10)]
+    assert len(set(context_id for ctx_id, context_id, arg in ran)) == 10
+    assert len(set(ctx_id for ctx_id, context_id, arg in ran)) == 5
+
+
+class _ControllerTransport:
+    def __init__(self, controller):
+        self._controller = controller
+        self.calls = []
+
+    async def hello(self, weight=None):
+        return self._controller.hello(weight)
+
+    async def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        self.calls.append(('request_work', completed_data_ids))
+        return self._controller.request_work(runner_id, current_work, completed_data_ids, max_work, runner_stats)
+
+    async def lease_data(self, runner_id, scenario_id, returned, lease=True):
+        self.calls.append(('lease_data', returned))
+        return self._controller.lease_data(runner_id, scenario_id, returned, lease)
+
+    async def bye(self, runner_id):
+        return self._controller.bye(runner_id)
+
+
+def test_partitioned_data_is_checked_out_by_the_runner():
+    del ran[:]
+    datapool = PartitionedDataPool([(i,) for i in range(25)], shard_size=10, recycle=False)
+    scenario_manager = ScenarioManager()
+    scenario_manager.add_scenario(__name__ + ':journey', datapool, lambda start, end: 5)
+    transport = _ControllerTransport(Controller('test', scenario_manager, ConfigManager()))
+    loop = asyncio.new_event_loop()
+    runner = Runner(transport, lambda msg: None, loop_wait_min=0, loop_wait_max=0.01, loop=loop)
+    loop.run_until_complete(runner.run())
+    loop.close()
+    assert sorted(arg for ctx_id, context_id, arg in ran) == list(range(25))
+    assert all(not completed for call, completed in transport.calls if call == 'request_work')
+    assert len([call for call, returned in transport.calls if call == 'lease_data']) <= 6
+    assert datapool.exhausted
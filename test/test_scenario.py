@@ -0,0 +1,47 @@
+from collections import Counter
+
+from mite.datapools import DataPoolItem
+from mite.scenario import ScenarioManager, _DeficitSampler
+
+
+def test_deficit_sampler_draws_each_id_deficit_times():
+    sampler = _DeficitSampler({1: 3, 2: 0, 3: 5, 4: 1})
+    drawn = Counter(sampler.draw() for _ in range(9))
+    assert drawn == {1: 3, 3: 5, 4: 1}
+    assert not sampler
+
+
+def test_get_work_shares_in_proportion_to_deficit():
+    scenario_manager = ScenarioManager()
+    scenario_manager.add_scenario('mite.example:journey', None, lambda start, end: 3000)
+    scenario_manager.add_scenario('mite.example:journey', None, lambda start, end: 1000)
+    counts = Counter()
+    for _ in range(100):
+        work, scenario_volume_map = scenario_manager.get_work({}, 0, 1, 40, 1)
+        assert len(work) == 40
+        counts.update(scenario_volume_map)
+    assert 0.7 < counts[1] / 4000 < 0.8
+
+
+class _CheckoutOnlyDataPool:
+    def __init__(self, size):
+        self._free = list(range(size, 0, -1))
+
+    def checkout(self):
+        if self._free:
+            id = self._free.pop()
+            return DataPoolItem(id, (id,))
+        return None
+
+    def checkin(self, id):
+        self._free.append(id)
+
+
+def test_get_work_checks_out_from_pools_without_checkout_many():
+    scenario_manager = ScenarioManager()
+    scenario_manager.add_scenario('mite.example:journey', _CheckoutOnlyDataPool(3), lambda start, end: 5)
+    scenario_manager.add_scenario('mite.example:journey', None, lambda start, end: 5)
+    work, scenario_volume_map = scenario_manager.get_work({}, 0, 1, None, 1)
+    assert sorted(args for scenario_id, scenario_data_id, journey_spec, args, start_delay in work if scenario_id == 1) == [
+        (1,), (2,), (3,)]
+    assert scenario_volume_map == {1: 3, 2: 5}
@@ -0,0 +1,28 @@
+from mite.utils import pack_msg, unpack_msgs, compress_frame, decompress_frame, check_compression_codec, StreamDecoder
+
+
+def test_compressed_frame_roundtrip():
+    msgs = [{'type': 'start', 'transaction': '__root__', 'time': float(i)} for i in range(100)]
+    frame = b''.join(pack_msg(msg) for msg in msgs)
+    compressed = compress_frame(frame, check_compression_codec('zlib'))
+    assert len(compressed) < len(frame)
+    assert unpack_msgs(decompress_frame(compressed)) == msgs
+    assert decompress_frame(frame) == frame
+
+
+def test_decode_stream_mixed_frames():
+    codec = check_compression_codec('zlib')
+    data = b''.join([
+        pack_msg({'n': 1}) + pack_msg({'n': 2}),
+        compress_frame(pack_msg({'n': 3}), codec),
+        compress_frame(pack_msg({'n': 4}) + pack_msg({'n': 5}), codec),
+        pack_msg({'n': 6}),
+    ])
+    assert [msg['n'] for msg in StreamDecoder().decode_stream(data)] == [1, 2, 3, 4, 5, 6]
+
+
+def test_decode_frame_interned_keys():
+    decoder = StreamDecoder(intern_keys=True)
+    a, b = decoder.decode_frame(pack_msg({'some_key': 1}) + pack_msg({'some_key': 2}))
+    assert [msg['some_key'] for msg in (a, b)] == [1, 2]
+    assert list(a)[0] is list(b)[0]
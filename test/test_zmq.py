@@ -0,0 +1,70 @@
+import asyncio
+
+from mite.zmq import Sender, ControllerServer, RunnerTransport
+
+
+def _sender(loop, batch_size, batch_delay):
+    sender = Sender(batch_size=batch_size, batch_delay=batch_delay, loop=loop)
+    frames = []
+    sender._send_frame = lambda frame, msg_types: frames.append((frame, list(msg_types)))
+    return sender, frames
+
+
+def test_batch_sent_when_full():
+    loop = asyncio.new_event_loop()
+    sender, frames = _sender(loop, 3, 60)
+    for i in range(7):
+        sender.send({'type': 'start', 'n': i})
+    assert [msg_types for frame, msg_types in frames] == [['start'] * 3] * 2
+    sender.flush()
+    assert len(frames) == 3 and frames[-1][1] == ['start']
+    loop.close()
+
+
+def test_batch_sent_after_delay():
+    loop = asyncio.new_event_loop()
+    sender, frames = _sender(loop, 100, 0.01)
+    sender.send({'type': 'start'})
+    sender.send({'type': 'end'})
+    assert frames == []
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert [msg_types for frame, msg_types in frames] == [['start', 'end']]
+    loop.close()
+
+
+class _Controller:
+    def hello(self, weight=None):
+        return 1, 'test', [], []
+
+    def request_work(self, runner_id, current_work, completed_data_ids, max_work, runner_stats=None):
+        return [], [], False
+
+    def bye(self, runner_id):
+        pass
+
+
+def test_controller_server_forgets_replies(tmp_path):
+    address = 'ipc://%s' % (tmp_path / 'controller',)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = ControllerServer(address, reply_ttl=0.05, loop=loop)
+    server_task = loop.create_task(server.run(_Controller()))
+    leaving, staying = RunnerTransport(address, loop=loop), RunnerTransport(address, loop=loop)
+
+    async def run():
+        await leaving.hello()
+        await staying.hello()
+        assert len(server._last_replies) == 2
+        await leaving.bye(1)
+        assert len(server._last_replies) == 1
+        await asyncio.sleep(0.1)
+        await leaving.hello()
+        # Quiet for longer than reply_ttl
+        assert len(server._last_replies) == 1
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        server_task.cancel()
+        asyncio.set_event_loop(None)
+        loop.close()